@@ -225,4 +225,14 @@ class StudentProfileForm(forms.ModelForm):
             'location_privacy': 'Choose who can see your current location when you\'re studying on campus',
             'current_location': 'Set your current location to help classmates find you',
         }
+    
+    def save(self, commit=True):
+        profile = super().save(commit=False)
+        # Picking a location counts as a fresh location update
+        if 'current_location' in self.changed_data and profile.current_location_id:
+            profile.location_updated_at = timezone.now()
+        if commit:
+            profile.save()
+            self._save_m2m()
+        return profile
 
@@ -0,0 +1,77 @@
+"""
+Clear the location of students whose presence has gone stale.
+
+Meant to run periodically (e.g. from cron every few minutes):
+
+    python manage.py expire_stale_presence
+
+Cron runs the command in its own process. The database is always cleared,
+and nearby pages check it, so expired students drop out of them straight
+away. Presence counters and live dashboards are only updated when they are
+shared between processes, i.e. with PRESENCE_REDIS_URL and a Redis channel
+layer. Otherwise the command warns and leaves them to catch up at the next
+rebuild (every PRESENCE_REBUILD_INTERVAL seconds).
+"""
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from accounts import presence
+from accounts.models import StudentProfile
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = 'Clear the location of students who have not updated it within PRESENCE_TTL seconds'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many students are stale',
+        )
+
+    def process_local_presence(self):
+        """Names of presence backends that other processes can't see"""
+        local = []
+        if isinstance(caches['presence'], LocMemCache):
+            local.append('the presence cache (set PRESENCE_REDIS_URL)')
+        channel_layer = get_channel_layer()
+        if channel_layer is None or isinstance(channel_layer, InMemoryChannelLayer):
+            local.append('the channel layer (set CHANNEL_REDIS_URLS)')
+        return local
+
+    def handle(self, *args, **options):
+        stale_ids = list(StudentProfile.objects.stale_presence().values_list('id', flat=True))
+
+        if options['dry_run']:
+            self.stdout.write(f'{len(stale_ids)} student(s) with stale presence')
+            return
+
+        local = self.process_local_presence()
+        if local:
+            self.stderr.write(self.style.WARNING(
+                f'Not updating live presence: {" and ".join(local)} is local to this process. '
+                'Nearby pages stop listing expired students now; counters catch up at the next rebuild.'
+            ))
+
+        expired = 0
+        for start in range(0, len(stale_ids), BATCH_SIZE):
+            batch = stale_ids[start:start + BATCH_SIZE]
+            with transaction.atomic():
+                # Re-check staleness so students who just updated their location are kept
+                expired += StudentProfile.objects.filter(id__in=batch).stale_presence().update(
+                    current_location=None,
+                    current_latitude=None,
+                    current_longitude=None,
+                    current_address='',
+                    location_cell='',
+                )
+                # update() skips signals, so sync presence counters and dashboards here
+                if not local:
+                    for profile in StudentProfile.objects.filter(id__in=batch):
+                        presence.update_student(profile)
+
+        self.stdout.write(self.style.SUCCESS(f'Expired presence for {expired} student(s)'))
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-16 22:30
+
+from django.db import migrations, models
+
+
+def populate_location_cells(apps, schema_editor):
+    """Compute grid cells for profiles that already have GPS coordinates"""
+    from locations.geo import grid_cell
+    StudentProfile = apps.get_model('accounts', 'StudentProfile')
+    
+    profiles = list(StudentProfile.objects.filter(
+        current_latitude__isnull=False,
+        current_longitude__isnull=False,
+    ))
+    for profile in profiles:
+        profile.location_cell = grid_cell(profile.current_latitude, profile.current_longitude)
+    StudentProfile.objects.bulk_update(profiles, ['location_cell'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_studentprofile_current_latitude_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentprofile',
+            name='location_cell',
+            field=models.CharField(blank=True, db_index=True, help_text='Grid cell of the GPS coordinates (spatial index)', max_length=32),
+        ),
+        migrations.RunPython(populate_location_cells, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-16 22:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_studentprofile_location_cell'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentprofile',
+            name='current_address',
+            field=models.CharField(blank=True, help_text='Address resolved from the GPS coordinates', max_length=500),
+        ),
+    ]
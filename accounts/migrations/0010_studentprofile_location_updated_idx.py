@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-16 22:44
+
+from django.db import migrations, models
+
+
+def timestamp_selected_locations(apps, schema_editor):
+    """Locations picked from the profile form never recorded a timestamp; use the last profile update"""
+    StudentProfile = apps.get_model('accounts', 'StudentProfile')
+    StudentProfile.objects.filter(
+        current_location__isnull=False,
+        location_updated_at__isnull=True,
+    ).update(location_updated_at=models.F('updated_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_studentprofile_current_address'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='studentprofile',
+            index=models.Index(fields=['location_updated_at'], name='accounts_location_updated_idx'),
+        ),
+        migrations.RunPython(timestamp_selected_locations, migrations.RunPython.noop),
+    ]
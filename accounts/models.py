@@ -1,7 +1,11 @@
+from datetime import timedelta
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
-from math import radians, cos, sin, asin, sqrt
+from django.db.models.functions import Coalesce
+from locations import geo
 
 class Class(models.Model):
     """Model for academic classes/courses"""
@@ -39,6 +43,115 @@ class StudentClass(models.Model):
     def __str__(self):
         return f"{self.student.name} - {self.course.code} ({self.get_expertise_level_display()})"
 
+def presence_cutoff():
+    """Oldest location update that still counts as present"""
+    return timezone.now() - timedelta(seconds=getattr(settings, 'PRESENCE_TTL', 7200))
+
+class StudentProfileQuerySet(models.QuerySet):
+    """Custom queryset for StudentProfile lookups"""
+    
+    @staticmethod
+    def _location_visible_q(viewer):
+        """
+        SQL equivalent of StudentProfile.can_view_location(viewer): public
+        profiles, plus classmates-only profiles sharing a class with the viewer.
+        """
+        visible = models.Q(location_privacy='public')
+        if viewer is not None:
+            viewer_courses = StudentClass.objects.filter(student=viewer).values('course_id')
+            shares_class = models.Exists(
+                StudentClass.objects.filter(student=models.OuterRef('pk'), course_id__in=viewer_courses)
+            )
+            visible |= models.Q(location_privacy='classmates') & shares_class
+        return visible
+    
+    def visible_to(self, viewer):
+        """Only profiles whose location the viewer is allowed to see"""
+        return self.filter(self._location_visible_q(viewer))
+    
+    def annotate_location_visibility(self, viewer):
+        """Annotate each profile with can_see_location for the viewer"""
+        return self.annotate(
+            can_see_location=models.ExpressionWrapper(
+                self._location_visible_q(viewer),
+                output_field=models.BooleanField(),
+            )
+        )
+    
+    def annotate_matching_score(self, viewer):
+        """
+        Annotate each profile with shared_class_count and matching_score relative
+        to the viewer, mirroring StudentProfile.get_matching_score in SQL:
+        shared classes x10, same visible location +5, both public +3, same year +2.
+        """
+        shared_class_count = Coalesce(
+            models.Subquery(
+                StudentClass.objects
+                .filter(student=models.OuterRef('pk'), course__code__in=viewer.get_class_codes())
+                .order_by()
+                .values('student')
+                .annotate(count=models.Count('id'))
+                .values('count')[:1],
+                output_field=models.IntegerField(),
+            ),
+            0,
+        )
+        qs = self.annotate(shared_class_count=shared_class_count)
+        
+        # Same location only counts if the viewer's location is visible to the other profile
+        same_location = models.Value(0)
+        if viewer.current_location_id and viewer.location_privacy in ('public', 'classmates'):
+            condition = models.Q(current_location_id=viewer.current_location_id)
+            if viewer.location_privacy == 'classmates':
+                condition &= models.Q(shared_class_count__gt=0)
+            same_location = models.Case(models.When(condition, then=models.Value(5)), default=models.Value(0))
+        
+        both_public = models.Value(0)
+        if viewer.location_privacy == 'public':
+            both_public = models.Case(
+                models.When(location_privacy='public', then=models.Value(3)),
+                default=models.Value(0),
+            )
+        
+        same_year = models.Case(
+            models.When(year=viewer.year, then=models.Value(2)),
+            default=models.Value(0),
+        )
+        
+        return qs.annotate(
+            matching_score=models.ExpressionWrapper(
+                models.F('shared_class_count') * 10 + same_location + both_public + same_year,
+                output_field=models.IntegerField(),
+            )
+        )
+    
+    def fresh_presence(self):
+        """Only profiles whose location was updated within PRESENCE_TTL seconds"""
+        return self.filter(location_updated_at__gte=presence_cutoff())
+    
+    def stale_presence(self):
+        """Profiles still holding a location that hasn't been updated within PRESENCE_TTL seconds"""
+        has_location = (
+            models.Q(current_location__isnull=False)
+            | models.Q(current_latitude__isnull=False)
+            | models.Q(current_longitude__isnull=False)
+        )
+        is_stale = models.Q(location_updated_at__lt=presence_cutoff()) | models.Q(location_updated_at__isnull=True)
+        return self.filter(has_location & is_stale)
+    
+    def within_radius_candidates(self, latitude, longitude, radius_meters):
+        """
+        Narrow down to profiles that may be within radius_meters of a point.
+        Uses the grid cell index plus a bounding-box prefilter; callers still
+        need to run the exact distance check on the results.
+        """
+        min_lat, max_lat, min_lon, max_lon = geo.bounding_box(latitude, longitude, radius_meters)
+        return self.filter(
+            location_cell__in=geo.cells_within(latitude, longitude, radius_meters),
+            current_latitude__range=(min_lat, max_lat),
+            current_longitude__range=(min_lon, max_lon),
+        )
+
 class StudentProfile(models.Model):
     """Profile model for Student users"""
     YEAR_CHOICES = [
@@ -70,27 +183,94 @@ class StudentProfile(models.Model):
     current_latitude = models.FloatField(null=True, blank=True, help_text="Current latitude coordinate")
     current_longitude = models.FloatField(null=True, blank=True, help_text="Current longitude coordinate")
     location_updated_at = models.DateTimeField(null=True, blank=True, help_text="When the GPS location was last updated")
+    current_address = models.CharField(max_length=500, blank=True, help_text="Address resolved from the GPS coordinates")
+    location_cell = models.CharField(max_length=32, blank=True, db_index=True, help_text="Grid cell of the GPS coordinates (spatial index)")
     is_active = models.BooleanField(default=True, help_text="Currently using StudyIt")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = StudentProfileQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['location_updated_at'], name='accounts_location_updated_idx'),
+        ]
     
     def __str__(self):
         return f"{self.name} - {self.get_year_display()}"
     
+    def has_fresh_presence(self):
+        """Check if the location was updated within PRESENCE_TTL seconds"""
+        return self.location_updated_at is not None and self.location_updated_at >= presence_cutoff()
+    
+    def save(self, *args, **kwargs):
+        """Keep the grid cell index in sync with the GPS coordinates"""
+        self.location_cell = geo.grid_cell(self.current_latitude, self.current_longitude)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'current_latitude', 'current_longitude'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'location_cell'}
+        super().save(*args, **kwargs)
+    
     def get_classes_display(self):
         """Return comma-separated list of class codes"""
         return ", ".join([sc.course.code for sc in self.student_classes.all()])
     
+    def get_class_codes(self):
+        """
+        Return the set of class codes for this profile.
+        Uses prefetched 'classes' or 'student_classes__course' when available.
+        """
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'classes' in prefetched:
+            return {cls.code for cls in prefetched['classes']}
+        if 'student_classes' in prefetched and all(
+            StudentClass.course.is_cached(sc) for sc in prefetched['student_classes']
+        ):
+            return {sc.course.code for sc in prefetched['student_classes']}
+        return set(self.classes.values_list('code', flat=True))
+    
     def get_shared_classes(self, other_profile):
         """Get list of classes shared with another student profile"""
         if not other_profile:
             return []
-        my_classes = set(self.classes.values_list('code', flat=True))
-        their_classes = set(other_profile.classes.values_list('code', flat=True))
-        return list(my_classes.intersection(their_classes))
+        return sorted(self.get_class_codes().intersection(other_profile.get_class_codes()))
+    
+    def get_shared_classes_bulk(self, profiles):
+        """
+        Get shared classes for many profiles at once.
+        
+        Profiles with prefetched classes are matched in memory; the rest are
+        resolved with a single query, so the cost doesn't grow with the number
+        of profiles.
+        
+        Returns:
+            dict: profile id -> sorted list of shared class codes
+        """
+        my_codes = self.get_class_codes()
+        shared = {profile.id: [] for profile in profiles}
+        if not my_codes:
+            return shared
+        
+        unresolved = []
+        for profile in profiles:
+            prefetched = getattr(profile, '_prefetched_objects_cache', {})
+            if 'classes' in prefetched or 'student_classes' in prefetched:
+                shared[profile.id] = sorted(my_codes.intersection(profile.get_class_codes()))
+            else:
+                unresolved.append(profile.id)
+        
+        if unresolved:
+            rows = StudentClass.objects.filter(
+                student_id__in=unresolved,
+                course__code__in=my_codes,
+            ).values_list('student_id', 'course__code')
+            for student_id, code in rows:
+                shared[student_id].append(code)
+            for student_id in unresolved:
+                shared[student_id].sort()
+        
+        return shared
     
     def can_view_location(self, viewer_profile):
         """
@@ -172,19 +352,7 @@ class StudentProfile(models.Model):
         """
         if not self.has_gps_coordinates():
             return None
-        
-        # Haversine formula
-        R = 6371000  # Earth's radius in meters
-        
-        lat1 = radians(self.current_latitude)
-        lat2 = radians(lat)
-        dlat = radians(lat - self.current_latitude)
-        dlon = radians(lon - self.current_longitude)
-        
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-        c = 2 * asin(sqrt(a))
-        
-        return R * c
+        return geo.haversine(self.current_latitude, self.current_longitude, lat, lon)
     
     def distance_to_profile(self, other_profile):
         """Calculate distance to another StudentProfile"""
@@ -0,0 +1,346 @@
+"""
+Live presence counters for the nearby dashboard.
+
+For every (Location, Class) pair the "presence" cache holds the set of
+student IDs currently at that location, enrolled in that class, and visible
+to classmates (active, location not hidden). Any viewer enrolled in the class
+is allowed to see those students, so the dashboard reads one entry per class
+instead of scanning profiles.
+
+Entries are updated incrementally by signals whenever a profile or its
+classes change (see signals.py). The whole structure is rebuilt from the
+database on a cold cache, and again once the freshness marker expires every
+PRESENCE_REBUILD_INTERVAL seconds so counters self-heal if concurrent writers
+from different processes ever race. Each rebuild writes a new generation of
+keys; older generations simply expire.
+
+The same diffs are pushed to the channel layer so open dashboards update
+without reloading (see chat.consumers.PresenceConsumer). Dashboards subscribe
+to one group per (location, class) pair plus a group for their own student,
+which tells them to resubscribe when the viewer moves or changes classes.
+That happens whether or not the viewer is visible to others, so the cache
+also remembers each student's own location and classes.
+"""
+import threading
+import time
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from .models import StudentProfile, StudentClass, Class
+
+GENERATION_KEY = 'presence:generation'
+FRESH_KEY = 'presence:fresh'
+
+_lock = threading.RLock()
+
+
+def _cache():
+    return caches['presence']
+
+
+def _rebuild_interval():
+    return getattr(settings, 'PRESENCE_REBUILD_INTERVAL', 300)
+
+
+def _generation_timeout():
+    # Outlive the freshness marker so the previous state is still there to diff against
+    return _rebuild_interval() * 2
+
+
+def _data_timeout():
+    # Outlive the generation marker so live keys never expire before it does
+    return _rebuild_interval() * 3
+
+
+def _group_key(generation, location_id, class_id):
+    return f'presence:{generation}:{location_id}:{class_id}'
+
+
+def _student_key(generation, student_id):
+    return f'presence:{generation}:student:{student_id}'
+
+
+def _viewer_key(student_id):
+    return f'presence:viewer:{student_id}'
+
+
+def group_name(location_id, class_id):
+    """Channel layer group for dashboards watching a class at a location"""
+    return f'presence_{location_id}_{class_id}'
+
+
+def student_group_name(student_id):
+    """Channel layer group notified when a student's own presence changes"""
+    return f'presence_student_{student_id}'
+
+
+def _pairs(membership):
+    if not membership:
+        return set()
+    location_id, class_ids = membership
+    return {(location_id, class_id) for class_id in class_ids}
+
+
+def _membership(profile, class_ids):
+    """Return (location_id, frozenset of class ids) if the profile counts, else None"""
+    if not profile.is_active or profile.location_privacy == 'hidden' or not profile.current_location_id:
+        return None
+    if not profile.has_fresh_presence():
+        return None
+    return (profile.current_location_id, frozenset(class_ids))
+
+
+def _generation():
+    return _cache().get(GENERATION_KEY)
+
+
+def _is_fresh():
+    return _cache().get(FRESH_KEY) is not None
+
+
+def clear():
+    """Forget all presence data; the next read rebuilds it"""
+    with _lock:
+        _cache().clear()
+
+
+def rebuild():
+    """Recompute every presence set from the database"""
+    profiles = StudentProfile.objects.filter(
+        is_active=True,
+        current_location__isnull=False,
+    ).exclude(location_privacy='hidden').fresh_presence()
+
+    class_ids_by_student = {}
+    for student_id, class_id in StudentClass.objects.filter(student__in=profiles).values_list('student_id', 'course_id'):
+        class_ids_by_student.setdefault(student_id, set()).add(class_id)
+
+    generation = time.time_ns()
+    data = {}
+    for profile in profiles.only('id', 'is_active', 'location_privacy', 'current_location', 'location_updated_at'):
+        membership = _membership(profile, class_ids_by_student.get(profile.id, ()))
+        data[_student_key(generation, profile.id)] = membership
+        location_id, class_ids = membership
+        for class_id in class_ids:
+            data.setdefault(_group_key(generation, location_id, class_id), set()).add(profile.id)
+
+    cache = _cache()
+    with _lock:
+        cache.set_many(data, timeout=_data_timeout())
+        cache.set(GENERATION_KEY, generation, timeout=_generation_timeout())
+        cache.set(FRESH_KEY, True, timeout=_rebuild_interval())
+    return generation
+
+
+def sync_student(profile, class_ids=None):
+    """
+    Bring a student's presence entries in line with the database.
+    Returns (old_membership, new_membership); memberships are
+    (location_id, frozenset(class_ids)) tuples or None.
+    On a cold cache there is nothing to diff against, so presence is rebuilt
+    and the student is reported as newly counted.
+    """
+    if class_ids is None:
+        class_ids = StudentClass.objects.filter(student_id=profile.id).values_list('course_id', flat=True)
+    new = _membership(profile, class_ids)
+
+    generation = _generation()
+    if generation is None:
+        rebuild()
+        return None, new
+
+    cache = _cache()
+    with _lock:
+        old = cache.get(_student_key(generation, profile.id))
+        if old == new:
+            if not _is_fresh():
+                rebuild()
+            return old, new
+
+        removed = _pairs(old)
+        added = _pairs(new)
+
+        keys = [_group_key(generation, *pair) for pair in removed ^ added]
+        current = cache.get_many(keys)
+        updates = {}
+        for location_id, class_id in removed - added:
+            key = _group_key(generation, location_id, class_id)
+            updates[key] = current.get(key, set()) - {profile.id}
+        for location_id, class_id in added - removed:
+            key = _group_key(generation, location_id, class_id)
+            updates[key] = current.get(key, set()) | {profile.id}
+
+        updates[_student_key(generation, profile.id)] = new
+        cache.set_many(updates, timeout=_data_timeout())
+        if not _is_fresh():
+            rebuild()
+    return old, new
+
+
+def _record_viewer(profile, class_ids):
+    """
+    Remember the location and classes a student's own dashboard follows.
+    Returns True if they changed, or weren't known.
+    """
+    state = (profile.current_location_id, frozenset(class_ids))
+    cache = _cache()
+    with _lock:
+        if cache.get(_viewer_key(profile.id)) == state:
+            return False
+        cache.set(_viewer_key(profile.id), state, timeout=_data_timeout())
+    return True
+
+
+def update_student(profile, class_ids=None, class_codes=None):
+    """
+    Sync a student's presence and publish the change once committed.
+    Callers updating many students can pass the student's class_ids and a
+    {class_id: code} dict to save the per-student queries.
+    """
+    if class_ids is None:
+        class_ids = list(StudentClass.objects.filter(student_id=profile.id).values_list('course_id', flat=True))
+    old, new = sync_student(profile, class_ids)
+    moved = _record_viewer(profile, class_ids)
+    if old != new or moved:
+        transaction.on_commit(lambda: publish_change(profile, old, new, moved=moved, class_codes=class_codes))
+    return old, new
+
+
+def remove_student(student_id):
+    """Drop a deleted student from every presence set; returns the old membership"""
+    cache = _cache()
+    cache.delete(_viewer_key(student_id))
+    generation = _generation()
+    if generation is None:
+        return None
+    with _lock:
+        old = cache.get(_student_key(generation, student_id))
+        if not old:
+            return old
+        location_id, class_ids = old
+        keys = [_group_key(generation, location_id, class_id) for class_id in class_ids]
+        current = cache.get_many(keys)
+        cache.set_many({key: current.get(key, set()) - {student_id} for key in keys}, timeout=_data_timeout())
+        cache.delete(_student_key(generation, student_id))
+    return old
+
+
+def students_at(location_id, class_ids):
+    """
+    Return {class_id: set of student IDs} visible to classmates at a location.
+    Reads one cache entry per class.
+    """
+    generation = _generation()
+    if generation is None or not _is_fresh():
+        generation = rebuild()
+    keys = {class_id: _group_key(generation, location_id, class_id) for class_id in class_ids}
+    found = _cache().get_many(list(keys.values()))
+    return {class_id: set(found.get(key, ())) for class_id, key in keys.items()}
+
+
+def student_payload(profile):
+    """JSON-friendly description of a classmate for the dashboard"""
+    location = profile.current_location
+    if profile.has_gps_coordinates():
+        latitude, longitude = profile.current_latitude, profile.current_longitude
+    elif location is not None and location.has_coordinates():
+        latitude, longitude = location.latitude, location.longitude
+    else:
+        latitude = longitude = None
+    return {
+        'id': profile.id,
+        'user_id': profile.user_id,
+        'name': profile.name,
+        'year': profile.get_year_display(),
+        'location_name': location.name if location else '',
+        'latitude': latitude,
+        'longitude': longitude,
+    }
+
+
+def snapshot(profile):
+    """
+    Return the visible classmates at a profile's current location, grouped by
+    class, in the shape the dashboard renders.
+    """
+    classes = list(profile.classes.order_by('code'))
+    location = profile.current_location
+    present = students_at(location.id, [cls.id for cls in classes]) if location else {}
+
+    student_ids = set().union(*present.values()) - {profile.id} if present else set()
+    # The cache only narrows the search; visibility is still checked in the database
+    profiles = (
+        StudentProfile.objects
+        .filter(id__in=student_ids, is_active=True, current_location=location)
+        .fresh_presence()
+        .visible_to(profile)
+        .select_related('current_location')
+    )
+    payloads = {p.id: student_payload(p) for p in profiles}
+
+    return {
+        'location': {'id': location.id, 'name': location.name} if location else None,
+        'classes': [
+            {
+                'id': cls.id,
+                'code': cls.code,
+                'students': sorted(
+                    (payloads[student_id] for student_id in present.get(cls.id, ()) if student_id in payloads),
+                    key=lambda student: student['name'].lower(),
+                ),
+            }
+            for cls in classes
+        ],
+    }
+
+
+def publish_change(profile, old, new, moved=False, class_codes=None):
+    """
+    Push a student's presence diff to subscribed dashboards.
+    Students who hide their location are reported as privacy changes;
+    other removals as departures. If moved, the student's own dashboard is
+    told to resubscribe. Codes missing from class_codes are looked up.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None or (old == new and not moved):
+        return
+    removed = _pairs(old)
+    added = _pairs(new)
+    class_codes = dict(class_codes or {})
+    missing = {class_id for _, class_id in removed | added} - class_codes.keys()
+    if missing:
+        class_codes.update(Class.objects.filter(id__in=missing).values_list('id', 'code'))
+    group_send = async_to_sync(channel_layer.group_send)
+
+    left_type = 'presence.privacy_changed' if new is None and profile.location_privacy == 'hidden' else 'presence.left'
+    for location_id, class_id in removed - added:
+        group_send(group_name(location_id, class_id), {
+            'type': left_type,
+            'student_id': profile.id,
+            'class_code': class_codes.get(class_id, ''),
+        })
+
+    if added - removed:
+        student = student_payload(profile)
+        for location_id, class_id in added - removed:
+            group_send(group_name(location_id, class_id), {
+                'type': 'presence.arrived',
+                'student': student,
+                'class_code': class_codes.get(class_id, ''),
+            })
+
+    if moved:
+        group_send(student_group_name(profile.id), {'type': 'presence.moved'})
+
+
+def publish_address(student_id, address):
+    """Push an address resolved in the background to the student's own open pages"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    async_to_sync(channel_layer.group_send)(student_group_name(student_id), {
+        'type': 'presence.address',
+        'address': address,
+    })
@@ -0,0 +1,129 @@
+"""
+Study buddy recommendations from a sparse student x class incidence index.
+
+The index keeps, for every class, the enrolled students and their expertise
+level (and the transpose, per student). A student's matches are the sparse
+product of their row with the class columns: every shared class adds
+SHARED_CLASS_WEIGHT, plus COMPLEMENTARITY_WEIGHT per level of expertise gap
+so beginners get paired with students who can help them.
+
+The index is built lazily from StudentClass, kept up to date incrementally by
+signals (see signals.py), and rebuilt after RECOMMENDATION_INDEX_TTL seconds
+so other worker processes pick up changes made elsewhere. Top matches are
+cached per student and dropped whenever one of their classes changes.
+"""
+import heapq
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from .models import StudentClass
+
+EXPERTISE_RANK = {
+    'beginner': 0,
+    'intermediate': 1,
+    'advanced': 2,
+}
+
+SHARED_CLASS_WEIGHT = 10
+COMPLEMENTARITY_WEIGHT = 5
+
+# Number of matches cached per student
+MAX_CACHED_MATCHES = 50
+
+
+class BuddyRecommender:
+    """In-memory recommendation index"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_class = None
+        self._by_student = None
+        self._top_matches = {}
+        self._built_at = 0
+
+    def _ttl(self):
+        return getattr(settings, 'RECOMMENDATION_INDEX_TTL', 600)
+
+    def _ensure_built(self):
+        if self._by_class is None or time.monotonic() - self._built_at > self._ttl():
+            self.rebuild()
+
+    def rebuild(self):
+        """Load the full incidence index from the database"""
+        by_class = defaultdict(dict)
+        by_student = defaultdict(dict)
+        rows = StudentClass.objects.filter(student__is_active=True).values_list(
+            'student_id', 'course_id', 'expertise_level'
+        )
+        for student_id, class_id, level in rows:
+            rank = EXPERTISE_RANK.get(level, 0)
+            by_class[class_id][student_id] = rank
+            by_student[student_id][class_id] = rank
+        with self._lock:
+            self._by_class = by_class
+            self._by_student = by_student
+            self._top_matches = {}
+            self._built_at = time.monotonic()
+
+    def invalidate(self):
+        """Drop the index; the next lookup rebuilds it"""
+        with self._lock:
+            self._by_class = None
+            self._by_student = None
+            self._top_matches = {}
+
+    def _invalidate_class(self, class_id):
+        """Drop cached matches for everyone enrolled in a class"""
+        for student_id in self._by_class.get(class_id, ()):
+            self._top_matches.pop(student_id, None)
+
+    def set_enrollment(self, student_id, class_id, expertise_level):
+        """Add or update one enrollment"""
+        with self._lock:
+            if self._by_class is None:
+                return
+            rank = EXPERTISE_RANK.get(expertise_level, 0)
+            self._by_class[class_id][student_id] = rank
+            self._by_student[student_id][class_id] = rank
+            self._invalidate_class(class_id)
+
+    def remove_enrollment(self, student_id, class_id):
+        """Remove one enrollment"""
+        with self._lock:
+            if self._by_class is None:
+                return
+            self._invalidate_class(class_id)
+            self._by_class.get(class_id, {}).pop(student_id, None)
+            self._by_student.get(student_id, {}).pop(class_id, None)
+            self._top_matches.pop(student_id, None)
+
+    def _score(self, student_id):
+        """Sparse row x matrix product for one student"""
+        scores = defaultdict(int)
+        for class_id, my_rank in self._by_student.get(student_id, {}).items():
+            for other_id, other_rank in self._by_class[class_id].items():
+                if other_id != student_id:
+                    scores[other_id] += SHARED_CLASS_WEIGHT + COMPLEMENTARITY_WEIGHT * abs(my_rank - other_rank)
+        return scores
+
+    def top_matches(self, student_id, k=10):
+        """
+        Return up to k (student_id, score) tuples for the best matches,
+        highest score first (ties broken by student id).
+        """
+        with self._lock:
+            self._ensure_built()
+            matches = self._top_matches.get(student_id)
+            if matches is None:
+                scores = self._score(student_id)
+                matches = heapq.nsmallest(
+                    MAX_CACHED_MATCHES,
+                    scores.items(),
+                    key=lambda item: (-item[1], item[0]),
+                )
+                self._top_matches[student_id] = matches
+            return matches[:k]
+
+
+recommender = BuddyRecommender()
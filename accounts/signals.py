@@ -0,0 +1,47 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import StudentProfile, StudentClass
+from .recommendations import recommender
+from . import presence
+
+
+def _sync_presence_for(student_id):
+    profile = StudentProfile.objects.filter(id=student_id).select_related('current_location').first()
+    if profile is None:
+        presence.remove_student(student_id)
+    else:
+        presence.update_student(profile)
+
+
+@receiver(post_save, sender=StudentClass)
+def update_recommendations_on_enroll(sender, instance, **kwargs):
+    """Keep the recommendation index in sync when a class is added or updated"""
+    recommender.set_enrollment(instance.student_id, instance.course_id, instance.expertise_level)
+
+
+@receiver(post_delete, sender=StudentClass)
+def update_recommendations_on_unenroll(sender, instance, **kwargs):
+    """Keep the recommendation index in sync when a class is removed"""
+    recommender.remove_enrollment(instance.student_id, instance.course_id)
+
+
+@receiver(post_save, sender=StudentClass)
+@receiver(post_delete, sender=StudentClass)
+def update_presence_on_class_change(sender, instance, **kwargs):
+    """Move the student between per-class presence sets when classes change"""
+    _sync_presence_for(instance.student_id)
+
+
+@receiver(post_save, sender=StudentProfile)
+def update_presence_on_profile_save(sender, instance, **kwargs):
+    """Refresh presence when location, privacy or active status may have changed"""
+    presence.update_student(instance)
+
+
+@receiver(post_delete, sender=StudentProfile)
+def update_presence_on_profile_delete(sender, instance, **kwargs):
+    """Drop a deleted student from presence"""
+    old = presence.remove_student(instance.id)
+    if old:
+        transaction.on_commit(lambda: presence.publish_change(instance, old, None))
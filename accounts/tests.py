@@ -1,3 +1,321 @@
-from django.test import TestCase
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils import timezone
+from django.urls import reverse
+from django.db.models import prefetch_related_objects
+from .models import StudentProfile, Class, StudentClass
+from .recommendations import recommender
+from . import presence
 
-# Create your tests here.
+
+def make_profile(username, classes=(), **fields):
+    """
+    Create a student named after their username and enroll them in classes.
+    classes may also be a {class: expertise_level} dict.
+    """
+    user = User.objects.create_user(username=username, password='password')
+    fields.setdefault('year', 'junior')
+    profile = StudentProfile.objects.create(user=user, name=username, **fields)
+    levels = classes if isinstance(classes, dict) else dict.fromkeys(classes, 'beginner')
+    for cls, level in levels.items():
+        StudentClass.objects.create(student=profile, course=cls, expertise_level=level)
+    return profile
+
+
+class GridCellIndexTest(TestCase):
+    def setUp(self):
+        # Klaus building and a point ~5 km away
+        self.near = make_profile('near', current_latitude=33.7771, current_longitude=-84.3963)
+        self.far = make_profile('far', current_latitude=33.8200, current_longitude=-84.3963)
+
+    def test_save_sets_location_cell(self):
+        self.assertTrue(self.near.location_cell)
+
+        self.near.current_latitude = None
+        self.near.current_longitude = None
+        self.near.save(update_fields=['current_latitude', 'current_longitude'])
+        self.near.refresh_from_db()
+        self.assertEqual(self.near.location_cell, '')
+
+    def test_within_radius_candidates(self):
+        # Point near the Clough Commons, a few hundred meters from Klaus
+        candidates = StudentProfile.objects.within_radius_candidates(33.7748, -84.3964, 1000)
+        self.assertEqual(list(candidates), [self.near])
+
+
+class SharedClassesTest(TestCase):
+    def setUp(self):
+        self.cs2340 = Class.objects.create(code='TEST2340', name='Objects and Design')
+        self.cs1332 = Class.objects.create(code='TEST1332', name='Data Structures')
+        self.math = Class.objects.create(code='TEST1554', name='Linear Algebra')
+
+        self.viewer = make_profile('viewer', [self.cs2340, self.cs1332])
+        self.others = [
+            make_profile('other1', [self.cs2340]),
+            make_profile('other2', [self.cs2340, self.cs1332, self.math]),
+            make_profile('other3', [self.math]),
+        ]
+
+    def expected(self):
+        return {
+            self.others[0].id: ['TEST2340'],
+            self.others[1].id: ['TEST1332', 'TEST2340'],
+            self.others[2].id: [],
+        }
+
+    def test_bulk_without_prefetch_uses_constant_queries(self):
+        with self.assertNumQueries(2):
+            shared = self.viewer.get_shared_classes_bulk(self.others)
+        self.assertEqual(shared, self.expected())
+
+    def test_bulk_with_prefetch_uses_no_extra_queries(self):
+        prefetch_related_objects([self.viewer], 'classes')
+        candidates = list(
+            StudentProfile.objects.filter(id__in=[p.id for p in self.others]).prefetch_related('classes')
+        )
+        with self.assertNumQueries(0):
+            shared = self.viewer.get_shared_classes_bulk(candidates)
+            single = self.viewer.get_shared_classes(candidates[0])
+        self.assertEqual(shared, self.expected())
+        self.assertEqual(single, self.expected()[candidates[0].id])
+
+
+class MatchingScoreAnnotationTest(TestCase):
+    def setUp(self):
+        from locations.models import Location
+        self.library = Location.objects.create(name='Library Test')
+        self.classes = [Class.objects.create(code=f'TEST{i}', name=f'Test {i}') for i in range(3)]
+
+        self.viewer = make_profile('viewer', self.classes[:2], current_location=self.library)
+        make_profile('match', self.classes[:2], current_location=self.library)
+        make_profile('hidden', self.classes[:1], year='senior', location_privacy='hidden', current_location=self.library)
+        make_profile('classmate', self.classes[1:], location_privacy='classmates')
+        make_profile('stranger', year='senior')
+
+    def test_annotation_matches_python_score(self):
+        for privacy in ['public', 'classmates', 'hidden']:
+            self.viewer.location_privacy = privacy
+            self.viewer.save()
+            profiles = StudentProfile.objects.exclude(id=self.viewer.id).annotate_matching_score(self.viewer)
+            for profile in profiles:
+                self.assertEqual(profile.matching_score, self.viewer.get_matching_score(profile), profile.name)
+
+    def test_relevance_sort_orders_by_score(self):
+        self.client.force_login(self.viewer.user)
+        response = self.client.get(reverse('accounts:profile_list'), {'sort': 'relevance'})
+        names = [profile.name for profile in response.context['profiles']]
+        self.assertEqual(names[0], 'match')
+
+
+class BuddyRecommenderTest(TestCase):
+    def setUp(self):
+        recommender.invalidate()
+        self.cs = Class.objects.create(code='TEST2340', name='Objects and Design')
+        self.math = Class.objects.create(code='TEST1554', name='Linear Algebra')
+
+        self.viewer = make_profile('viewer', {self.cs: 'beginner', self.math: 'beginner'})
+        self.tutor = make_profile('tutor', {self.cs: 'advanced'})
+        self.peer = make_profile('peer', {self.cs: 'beginner', self.math: 'beginner'})
+        self.stranger = make_profile('stranger')
+
+    def test_scores_shared_classes_and_complementarity(self):
+        matches = recommender.top_matches(self.viewer.id)
+        # peer: 2 shared classes (20); tutor: 1 shared class + 2 levels apart (10 + 10)
+        self.assertEqual(matches, [(self.tutor.id, 20), (self.peer.id, 20)])
+
+    def test_incremental_updates(self):
+        recommender.top_matches(self.viewer.id)
+        StudentClass.objects.create(student=self.stranger, course=self.math, expertise_level='advanced')
+        self.assertIn((self.stranger.id, 20), recommender.top_matches(self.viewer.id))
+
+        StudentClass.objects.filter(student=self.peer, course=self.math).delete()
+        self.assertIn((self.peer.id, 10), recommender.top_matches(self.viewer.id))
+
+    def test_endpoint_skips_inactive_profiles(self):
+        self.tutor.is_active = False
+        self.tutor.save()
+        self.client.force_login(self.viewer.user)
+        response = self.client.get(reverse('accounts:recommended_buddies'))
+        names = [item['name'] for item in response.json()['recommendations']]
+        self.assertEqual(names, ['peer'])
+
+
+class LocationVisibilityQueryTest(TestCase):
+    def setUp(self):
+        self.shared = Class.objects.create(code='TEST2340', name='Objects and Design')
+        self.other = Class.objects.create(code='TEST1554', name='Linear Algebra')
+        self.viewer = make_profile('viewer', [self.shared])
+        make_profile('public')
+        make_profile('classmate', [self.shared, self.other], location_privacy='classmates')
+        make_profile('not_classmate', [self.other], location_privacy='classmates')
+        make_profile('hidden', [self.shared], location_privacy='hidden')
+
+    def test_visible_to_matches_can_view_location(self):
+        others = StudentProfile.objects.exclude(id=self.viewer.id)
+        expected = {p.name for p in others if p.can_view_location(self.viewer)}
+        with self.assertNumQueries(1):
+            visible = {p.name for p in others.visible_to(self.viewer)}
+        self.assertEqual(visible, expected)
+        self.assertIn('classmate', visible)
+        self.assertNotIn('not_classmate', visible)
+
+    def test_anonymous_viewer_sees_public_only(self):
+        names = set(StudentProfile.objects.visible_to(None).values_list('name', flat=True))
+        self.assertIn('public', names)
+        self.assertNotIn('classmate', names)
+
+    def test_annotate_location_visibility(self):
+        profiles = StudentProfile.objects.exclude(id=self.viewer.id).annotate_location_visibility(self.viewer)
+        for profile in profiles:
+            self.assertEqual(profile.can_see_location, profile.can_view_location(self.viewer), profile.name)
+
+
+class PresenceCountersTest(TestCase):
+    def setUp(self):
+        from locations.models import Location
+        presence.clear()
+        self.library = Location.objects.create(name='Library Test')
+        self.gym = Location.objects.create(name='Gym Test')
+        self.cs = Class.objects.create(code='TEST2340', name='Objects and Design')
+        self.math = Class.objects.create(code='TEST1554', name='Linear Algebra')
+        now = timezone.now()
+        self.viewer = make_profile('viewer', [self.cs, self.math], current_location=self.library, location_updated_at=now)
+        self.other = make_profile('other', [self.cs], current_location=self.library, location_updated_at=now)
+
+    def counts(self):
+        self.client.force_login(self.viewer.user)
+        response = self.client.get(reverse('accounts:nearby'))
+        return response.context['counts_by_class']
+
+    def test_counts_follow_profile_changes(self):
+        self.assertEqual(self.counts(), {'TEST2340': 1})
+
+        StudentClass.objects.create(student=self.other, course=self.math)
+        self.assertEqual(self.counts(), {'TEST2340': 1, 'TEST1554': 1})
+
+        self.other.location_privacy = 'hidden'
+        self.other.save()
+        self.assertEqual(self.counts(), {})
+
+        self.other.location_privacy = 'public'
+        self.other.current_location = self.gym
+        self.other.save()
+        self.assertEqual(self.counts(), {})
+        self.assertEqual(presence.students_at(self.gym.id, [self.cs.id]), {self.cs.id: {self.other.id}})
+
+    def test_counts_drop_deleted_students(self):
+        self.assertEqual(self.counts(), {'TEST2340': 1})
+        self.other.delete()
+        self.assertEqual(self.counts(), {})
+
+    def test_counts_recheck_the_database(self):
+        self.assertEqual(self.counts(), {'TEST2340': 1})
+        # Another worker's change that this process's cache never heard about
+        StudentProfile.objects.filter(id=self.other.id).update(location_privacy='hidden')
+        self.assertEqual(self.counts(), {})
+        StudentProfile.objects.filter(id=self.other.id).update(location_privacy='public', current_location=self.gym)
+        self.assertEqual(self.counts(), {})
+
+    def test_snapshot_rechecks_the_database(self):
+        StudentProfile.objects.filter(id=self.other.id).update(location_privacy='hidden')
+        classes = presence.snapshot(self.viewer)['classes']
+        self.assertEqual([cls['students'] for cls in classes], [[], []])
+
+    def published(self, change):
+        """Run a change and return the (group, event type) pairs it publishes"""
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        with mock.patch('accounts.presence.get_channel_layer', return_value=channel_layer):
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+        return [(call.args[0], call.args[1]['type']) for call in channel_layer.group_send.call_args_list]
+
+    def move_other_to_gym(self):
+        self.other.current_location = self.gym
+        self.other.save()
+
+    def test_publishes_when_refresh_is_due(self):
+        presence.students_at(self.library.id, [self.cs.id])
+        presence._cache().delete(presence.FRESH_KEY)
+
+        events = self.published(self.move_other_to_gym)
+        self.assertIn((presence.group_name(self.library.id, self.cs.id), 'presence.left'), events)
+        self.assertIn((presence.group_name(self.gym.id, self.cs.id), 'presence.arrived'), events)
+
+    def test_publishes_after_generation_expires(self):
+        presence.students_at(self.library.id, [self.cs.id])
+        presence._cache().delete(presence.GENERATION_KEY)
+
+        events = self.published(self.move_other_to_gym)
+        self.assertIn((presence.group_name(self.gym.id, self.cs.id), 'presence.arrived'), events)
+        self.assertEqual(presence.students_at(self.gym.id, [self.cs.id]), {self.cs.id: {self.other.id}})
+
+    def test_update_with_known_classes_skips_queries(self):
+        presence.students_at(self.library.id, [self.cs.id])
+        self.other.current_location = self.gym
+
+        def update():
+            presence.update_student(self.other, [self.cs.id], {self.cs.id: self.cs.code})
+
+        with self.assertNumQueries(0):
+            events = self.published(update)
+        self.assertIn((presence.group_name(self.gym.id, self.cs.id), 'presence.arrived'), events)
+
+    def test_hidden_viewer_is_told_to_resubscribe(self):
+        self.viewer.location_privacy = 'hidden'
+        self.viewer.save()
+
+        def move_viewer():
+            self.viewer.current_location = self.gym
+            self.viewer.save()
+
+        events = self.published(move_viewer)
+        self.assertEqual(events, [(presence.student_group_name(self.viewer.id), 'presence.moved')])
+        # Saving without moving doesn't resubscribe
+        self.assertEqual(self.published(self.viewer.save), [])
+
+
+@override_settings(PRESENCE_TTL=3600)
+class StalePresenceTest(TestCase):
+    def setUp(self):
+        from locations.models import Location
+        presence.clear()
+        self.library = Location.objects.create(name='Library Test')
+        self.cs = Class.objects.create(code='TEST2340', name='Objects and Design')
+        now = timezone.now()
+        here = {'current_location': self.library, 'current_latitude': 33.7771, 'current_longitude': -84.3963}
+        self.viewer = make_profile('viewer', [self.cs], location_updated_at=now, **here)
+        self.fresh = make_profile('fresh', [self.cs], location_updated_at=now - timedelta(minutes=30), **here)
+        self.stale = make_profile('stale', [self.cs], location_updated_at=now - timedelta(hours=3), **here)
+
+    def test_nearby_excludes_stale_students(self):
+        self.client.force_login(self.viewer.user)
+        response = self.client.get(reverse('accounts:nearby'))
+        members = response.context['grouped_by_class']['TEST2340']
+        self.assertEqual([p.name for p in members], ['fresh'])
+
+    def test_command_clears_stale_locations(self):
+        self.assertEqual(set(StudentProfile.objects.stale_presence()), {self.stale})
+        stderr = StringIO()
+        call_command('expire_stale_presence', stdout=StringIO(), stderr=stderr)
+        self.assertIn('PRESENCE_REDIS_URL', stderr.getvalue())
+
+        self.stale.refresh_from_db()
+        self.assertIsNone(self.stale.current_location)
+        self.assertIsNone(self.stale.current_latitude)
+        self.assertEqual(self.stale.location_cell, '')
+        self.assertFalse(StudentProfile.objects.stale_presence().exists())
+        self.assertEqual(
+            presence.students_at(self.library.id, [self.cs.id]),
+            {self.cs.id: {self.viewer.id, self.fresh.id}},
+        )
+
+    def test_command_updates_shared_presence(self):
+        from accounts.management.commands.expire_stale_presence import Command
+        with mock.patch.object(Command, 'process_local_presence', return_value=[]):
+            with mock.patch('accounts.presence.update_student') as update_student:
+                call_command('expire_stale_presence', stdout=StringIO())
+        self.assertEqual([call.args[0] for call in update_student.call_args_list], [self.stale])
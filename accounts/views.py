@@ -1,11 +1,16 @@
+from collections import defaultdict
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import JsonResponse
 from django.db import models
+from django.db.models import prefetch_related_objects
 from .forms import LoginForm, UserRegistrationForm, StudentProfileForm, StudentClassForm, ClassForm
 from .models import StudentProfile, TAProfile, Class, StudentClass
+from locations import geo
+from .recommendations import recommender
+from . import presence
 
 @login_required
 def nearby_classmates(request):
@@ -20,55 +25,64 @@ def nearby_classmates(request):
     current_location = current_profile.current_location
     
     # Prepare user classes (always needed for template)
+    prefetch_related_objects([current_profile], 'classes')
     user_classes_qs = current_profile.classes.all().order_by('code')
-    user_class_codes = set(user_classes_qs.values_list('code', flat=True))
     
     candidates = []
+    shared_by_profile = {}
     
     if current_location:
-        # Match by exact location ID
+        # Match by exact location ID using the live per-class presence sets
+        user_classes = list(user_classes_qs)
+        code_by_class_id = {cls.id: cls.code for cls in user_classes}
+        present = presence.students_at(current_location.id, code_by_class_id.keys())
+        
+        shared_by_profile = defaultdict(list)
+        for class_id, student_ids in present.items():
+            for student_id in student_ids - {current_profile.id}:
+                shared_by_profile[student_id].append(code_by_class_id[class_id])
+        
+        # The cache only narrows the search; visibility is still checked in the database
         candidates = list(
             StudentProfile.objects
-            .filter(is_active=True, current_location=current_location)
-            .exclude(id=current_profile.id)
+            .filter(id__in=shared_by_profile.keys(), is_active=True, current_location=current_location)
+            .fresh_presence()
+            .visible_to(current_profile)
             .select_related('user', 'current_location')
-            .prefetch_related('classes')
         )
     elif current_profile.has_gps_coordinates():
-        # Match by GPS distance (within 1000m)
-        all_gps_candidates = (
+        # Match by GPS distance (within 1000m), prefiltered by grid cell
+        all_gps_candidates = list(
             StudentProfile.objects
-            .filter(is_active=True, current_latitude__isnull=False)
+            .filter(is_active=True)
+            .fresh_presence()
+            .within_radius_candidates(current_profile.current_latitude, current_profile.current_longitude, 1000)
+            .visible_to(current_profile)
             .exclude(id=current_profile.id)
             .select_related('user', 'current_location')
             .prefetch_related('classes')
         )
         
-        candidates = []
-        for s in all_gps_candidates:
-            dist = current_profile.distance_to_profile(s)
-            # Use 1000m (1km) as nearby threshold for GPS
-            if dist is not None and dist <= 1000:
-                candidates.append(s)
+        # Use 1000m (1km) as nearby threshold for GPS
+        in_range = geo.nearest(
+            current_profile.current_latitude, current_profile.current_longitude,
+            [s.current_latitude for s in all_gps_candidates],
+            [s.current_longitude for s in all_gps_candidates],
+            max_distance=1000,
+        )
+        candidates = [all_gps_candidates[index] for index, _ in in_range]
+        shared_by_profile = current_profile.get_shared_classes_bulk(candidates)
     else:
         # No location set
         messages.info(request, 'Set your current location to see nearby classmates.')
 
     # Group visible classmates by shared classes and compute counts
-    from collections import defaultdict
     grouped_by_class = defaultdict(list)
     counts_by_class = defaultdict(int)
     
+    # Candidates are already filtered by location privacy relative to viewer
     for profile in candidates:
-        # Respect location privacy relative to viewer
-        if not profile.can_view_location(current_profile):
-            continue
-        
-        # Determine shared class codes
-        their_codes = set(profile.classes.values_list('code', flat=True))
-        shared_codes = their_codes.intersection(user_class_codes)
-        
-        for code in shared_codes:
+        for code in shared_by_profile[profile.id]:
             counts_by_class[code] += 1
             grouped_by_class[code].append(profile)
     
@@ -420,6 +434,9 @@ def profile_list(request):
     if current_profile:
         profiles = profiles.exclude(id=current_profile.id)
     
+    # Resolve location visibility relative to the viewer in the same query
+    profiles = profiles.annotate_location_visibility(current_profile)
+    
     # Search by name
     search_query = request.GET.get('search', '').strip()
     if search_query:
@@ -466,9 +483,8 @@ def profile_list(request):
     elif sort_by == 'year':
         profiles = profiles.order_by('year', 'name')
     elif sort_by == 'relevance' and current_profile:
-        # For relevance, we'll calculate shared classes (done in template for now)
-        # Could be optimized with annotation in the future
-        profiles = profiles.order_by('-created_at')
+        # Rank by matching score computed in the database
+        profiles = profiles.annotate_matching_score(current_profile).order_by('-matching_score', 'name')
     else:
         profiles = profiles.order_by('name')
     
@@ -479,11 +495,15 @@ def profile_list(request):
     page_obj = paginator.get_page(page_number)
     
     # Pre-calculate shared classes and visibility for each profile on current page
+    page_profiles = list(page_obj.object_list)
+    if current_profile:
+        prefetch_related_objects([current_profile], 'classes')
+        shared_by_profile = current_profile.get_shared_classes_bulk(page_profiles)
+    
     profiles_with_shared = []
-    for profile in page_obj.object_list:
+    for profile in page_profiles:
         if current_profile:
-            profile.shared_classes_list = profile.get_shared_classes(current_profile)
-            profile.can_see_location = profile.can_view_location(current_profile)
+            profile.shared_classes_list = shared_by_profile[profile.id]
         else:
             profile.shared_classes_list = []
             profile.can_see_location = False
@@ -514,3 +534,40 @@ def profile_list(request):
     }
     
     return render(request, 'accounts/profile_list.html', context)
+
+@login_required
+def recommended_buddies(request):
+    """API endpoint returning the best study buddy matches for the current user"""
+    try:
+        profile = request.user.student_profile
+    except StudentProfile.DoesNotExist:
+        return JsonResponse({'error': 'Profile not found'}, status=400)
+    
+    try:
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 50)
+    except (TypeError, ValueError):
+        limit = 10
+    
+    matches = recommender.top_matches(profile.id, k=50)
+    scores = dict(matches)
+    
+    # Inactive students may still be in the index until it is rebuilt
+    candidates = StudentProfile.objects.filter(
+        id__in=scores.keys(), is_active=True
+    ).select_related('user').prefetch_related('classes')
+    candidates = sorted(candidates, key=lambda p: (-scores[p.id], p.id))[:limit]
+    
+    prefetch_related_objects([profile], 'classes')
+    shared_by_profile = profile.get_shared_classes_bulk(candidates)
+    
+    return JsonResponse({
+        'success': True,
+        'recommendations': [{
+            'id': candidate.id,
+            'user_id': candidate.user.id,
+            'name': candidate.name,
+            'year': candidate.get_year_display(),
+            'score': scores[candidate.id],
+            'shared_classes': shared_by_profile[candidate.id],
+        } for candidate in candidates],
+    })
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import ChatRequest, ChatRoom, Message, Call
+from .models import ChatRequest, ChatRoom, Message, ChatReadCursor, Call
 
 @admin.register(ChatRequest)
 class ChatRequestAdmin(admin.ModelAdmin):
@@ -26,6 +26,12 @@ class MessageAdmin(admin.ModelAdmin):
         return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
     content_preview.short_description = 'Content'
 
+@admin.register(ChatReadCursor)
+class ChatReadCursorAdmin(admin.ModelAdmin):
+    list_display = ['participant', 'room', 'last_read_at', 'updated_at']
+    search_fields = ['participant__name', 'room__room_name']
+    readonly_fields = ['updated_at']
+
 @admin.register(Call)
 class CallAdmin(admin.ModelAdmin):
     list_display = ['caller', 'receiver', 'call_type', 'status', 'initiated_at', 'duration_display']
@@ -0,0 +1,157 @@
+"""
+Write-behind persistence for chat messages sent over the WebSocket.
+
+CHAT_MESSAGE_DURABILITY decides when a message reaches the database:
+
+"buffered" (default)
+    The message gets its uid and timestamp in memory, is broadcast to the room
+    straight away and is queued. Queued messages are written with one
+    bulk_create, plus one UPDATE of the rooms' updated_at, every
+    CHAT_MESSAGE_FLUSH_INTERVAL seconds, or as soon as CHAT_MESSAGE_FLUSH_SIZE
+    messages are waiting. The queue is flushed when the process exits cleanly,
+    but messages queued when a worker crashes are lost (at most one interval's
+    worth). Until it is flushed, a message that was already broadcast is
+    missing from the history and polling endpoints.
+
+    If a batch fails to write, its messages are retried one by one. Messages
+    that still fail go back on the queue for the next flush, and are dropped
+    with an error in the log once they have failed
+    CHAT_MESSAGE_FLUSH_RETRIES flushes in a row.
+
+    Reads are tracked by the participant's ChatReadCursor, which already
+    covers messages still in the queue. Message.is_read is not set on
+    buffered messages read before they were written, so use the cursor
+    (ChatRoom.get_unread_count) rather than is_read for unread state.
+
+"sync"
+    The message is written before it is broadcast, so nothing the room has
+    seen can be lost. Every message costs its own INSERT and UPDATE on the
+    broadcast path.
+
+Messages sent through the HTTP send endpoint are always written synchronously.
+"""
+import atexit
+import logging
+import threading
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+from .db import executor
+from .models import ChatRoom, Message
+
+logger = logging.getLogger(__name__)
+
+BUFFERED = 'buffered'
+SYNC = 'sync'
+
+
+def is_buffered():
+    """Whether chat messages are written behind the broadcast"""
+    return getattr(settings, 'CHAT_MESSAGE_DURABILITY', BUFFERED) == BUFFERED
+
+
+def write_messages(messages):
+    """Insert messages and bump their rooms' updated_at in one transaction"""
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+        ChatRoom.objects.filter(
+            pk__in={message.room_id for message in messages}
+        ).update(updated_at=timezone.now())
+
+
+class MessageBuffer:
+    """Queue of unsaved messages, flushed in batches on the database pool"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Flushes run one at a time so batches are written in order
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._timer = None
+        # Failed flushes per message uid; only touched under _flush_lock
+        self._failures = {}
+
+    def add(self, message):
+        """Queue an unsaved message for the next batch"""
+        with self._lock:
+            self._pending.append(message)
+            if len(self._pending) >= getattr(settings, 'CHAT_MESSAGE_FLUSH_SIZE', 100):
+                self._cancel_timer()
+                executor.submit(self._flush_in_worker)
+            else:
+                self._schedule()
+
+    def pending_count(self):
+        """Number of messages waiting to be written"""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Write every queued message now. Returns how many were written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._cancel_timer()
+            if not batch:
+                return 0
+
+            try:
+                write_messages(batch)
+                return len(batch)
+            except DatabaseError:
+                logger.exception("Writing a batch of %d chat messages failed; retrying one by one", len(batch))
+
+            written = 0
+            retry = []
+            for message in batch:
+                try:
+                    write_messages([message])
+                    written += 1
+                    self._failures.pop(message.uid, None)
+                except DatabaseError:
+                    failures = self._failures.get(message.uid, 0) + 1
+                    if failures >= getattr(settings, 'CHAT_MESSAGE_FLUSH_RETRIES', 3):
+                        self._failures.pop(message.uid, None)
+                        logger.exception(
+                            "Dropping chat message %s after %d failed writes", message.uid, failures,
+                        )
+                    else:
+                        self._failures[message.uid] = failures
+                        logger.exception("Writing chat message %s failed; requeueing it", message.uid)
+                        retry.append(message)
+
+            if retry:
+                with self._lock:
+                    # Ahead of anything queued since, so messages stay in order
+                    self._pending[:0] = retry
+                    self._schedule()
+            return written
+
+    def _schedule(self):
+        # Callers hold _lock
+        if self._timer is None:
+            self._timer = threading.Timer(
+                getattr(settings, 'CHAT_MESSAGE_FLUSH_INTERVAL', 0.1),
+                executor.submit,
+                args=(self._flush_in_worker,),
+            )
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _flush_in_worker(self):
+        close_old_connections()
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Flushing chat messages failed")
+        finally:
+            close_old_connections()
+
+
+message_buffer = MessageBuffer()
+atexit.register(message_buffer.flush)
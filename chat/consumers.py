@@ -2,14 +2,42 @@
 WebSocket consumers for real-time chat
 """
 
+import asyncio
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.utils.dateparse import parse_datetime
 from accounts.models import StudentProfile
+from accounts import presence
+from .buffer import is_buffered, message_buffer, write_messages
+from .db import database_pool_to_async
 from .models import ChatRoom, Message
 
 
+def call_group_name(room_name, profile_id):
+    """Name of the signaling group for one participant of a call room"""
+    return f'call_{room_name}_{profile_id}'
+
+
+def load_room_access(user, room_name):
+    """
+    Look up the user's profile and the room once per connection.
+    Returns (profile, room), or (None, None) if the user can't join the room.
+    """
+    try:
+        user_profile = StudentProfile.objects.get(user=user)
+        chat_room = ChatRoom.objects.select_related('participant1', 'participant2').get(
+            room_name=room_name,
+            is_active=True,
+        )
+    except (StudentProfile.DoesNotExist, ChatRoom.DoesNotExist):
+        return None, None
+    if not chat_room.has_participant(user_profile):
+        return None, None
+    return user_profile, chat_room
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for handling real-time chat messages
@@ -20,15 +48,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'chat_{self.room_name}'
         self.user = self.scope['user']
+        # Newest message seen since the read cursor was last moved
+        self.unread_through = None
+        self.read_task = None
         
         # Verify user is authenticated and has access to this room
         if not self.user.is_authenticated:
             await self.close()
             return
         
-        # Check if user has access to this room
-        has_access = await self.check_room_access()
-        if not has_access:
+        # Resolve the profile and room once for the lifetime of the connection
+        self.user_profile, self.chat_room = await self.load_room_access()
+        if not self.chat_room:
             await self.close()
             return
 
@@ -39,9 +70,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
         await self.accept()
+        
+        # Opening the room reads everything in it
+        await self.mark_room_read()
 
     async def disconnect(self, close_code):
         """Leave room group"""
+        if self.read_task is not None:
+            self.read_task.cancel()
+            self.read_task = None
+        if self.unread_through is not None:
+            await self.flush_read()
+
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
@@ -56,24 +96,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
             if not message_content:
                 return
             
-            # Get user profile
-            user_profile = await self.get_user_profile()
-            if not user_profile:
-                await self.send(text_data=json.dumps({
-                    'error': 'User profile not found'
-                }))
-                return
-            
-            # Get chat room
-            chat_room = await self.get_chat_room()
-            if not chat_room:
-                await self.send(text_data=json.dumps({
-                    'error': 'Chat room not found'
-                }))
-                return
+            user_profile = self.user_profile
             
-            # Save message to database
-            message = await self.save_message(chat_room, user_profile, message_content)
+            # Save message to database, or queue it to be written after the broadcast
+            message = Message(room=self.chat_room, sender=user_profile, content=message_content)
+            if is_buffered():
+                message_buffer.add(message)
+            else:
+                await self.save_message(message)
             
             # Send message to room group
             await self.channel_layer.group_send(
@@ -84,8 +114,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'username': self.user.username,
                     'sender_name': user_profile.name,
                     'sender_id': user_profile.id,
-                    'timestamp': message.timestamp.isoformat() if message else None,
-                    'message_id': message.id if message else None,
+                    'timestamp': message.timestamp.isoformat(),
+                    # No id yet while the message waits in the write-behind buffer
+                    'message_id': message.id,
+                    'message_uid': str(message.uid),
                 }
             )
         except json.JSONDecodeError:
@@ -107,56 +139,65 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'sender_id': event.get('sender_id', ''),
             'timestamp': event.get('timestamp', ''),
             'message_id': event.get('message_id', ''),
+            'message_uid': event.get('message_uid', ''),
         }))
+        
+        # The user has the room open, so messages from the other participant are read
+        if event['username'] != self.user.username:
+            self.schedule_read(parse_datetime(event.get('timestamp') or ''))
     
-    @database_sync_to_async
-    def check_room_access(self):
-        """Check if user has access to this room"""
-        try:
-            user_profile = StudentProfile.objects.get(user=self.user)
-            chat_room = ChatRoom.objects.get(room_name=self.room_name, is_active=True)
-            return chat_room.has_participant(user_profile)
-        except (StudentProfile.DoesNotExist, ChatRoom.DoesNotExist):
-            return False
+    def schedule_read(self, through):
+        """
+        Move the read cursor past a message the user has seen. While messages
+        stream in, the cursor is moved at most once per
+        CHAT_READ_DEBOUNCE_SECONDS instead of once per message.
+        """
+        if through is None:
+            return
+        if self.unread_through is None or through > self.unread_through:
+            self.unread_through = through
+        if self.read_task is None:
+            self.read_task = asyncio.ensure_future(self.mark_read_later())
     
-    @database_sync_to_async
-    def get_user_profile(self):
-        """Get user's student profile"""
-        try:
-            return StudentProfile.objects.get(user=self.user)
-        except StudentProfile.DoesNotExist:
-            return None
+    async def mark_read_later(self):
+        await asyncio.sleep(getattr(settings, 'CHAT_READ_DEBOUNCE_SECONDS', 2))
+        self.read_task = None
+        await self.flush_read()
     
-    @database_sync_to_async
-    def get_chat_room(self):
-        """Get chat room"""
-        try:
-            return ChatRoom.objects.get(room_name=self.room_name, is_active=True)
-        except ChatRoom.DoesNotExist:
-            return None
+    async def flush_read(self):
+        """Mark the room read through the newest message seen so far"""
+        through, self.unread_through = self.unread_through, None
+        await self.mark_room_read(through=through)
     
-    @database_sync_to_async
-    def save_message(self, chat_room, sender, content):
-        """Save message to database"""
-        message = Message.objects.create(
-            room=chat_room,
-            sender=sender,
-            content=content
-        )
-        # Update room's updated_at timestamp
-        chat_room.save()
-        return message
+    @database_pool_to_async
+    def load_room_access(self):
+        """Return (profile, room) if the user may join this room, else (None, None)"""
+        return load_room_access(self.user, self.room_name)
+    
+    @database_pool_to_async
+    def save_message(self, message):
+        """Save message to database and bump the room's updated_at"""
+        write_messages([message])
+    
+    @database_pool_to_async
+    def mark_room_read(self, through=None):
+        """Mark the room read for this user"""
+        self.chat_room.mark_read(self.user_profile, through=through)
 
 
 class CallSignalingConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for handling WebRTC signaling for voice/video calls
+
+    Each connection joins a group for its own participant in the room, and
+    every signal is sent to the other participant's group only. The sender
+    never gets its own offer/answer/ICE echo back, so handlers need no
+    self-filtering.
     """
     
     async def connect(self):
         """Accept WebSocket connection for call signaling"""
         self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.call_group_name = f'call_{self.room_name}'
         self.user = self.scope['user']
         
         # Verify user is authenticated and has access to this room
@@ -164,15 +205,19 @@ class CallSignalingConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
         
-        # Check if user has access to this room
-        has_access = await self.check_room_access()
-        if not has_access:
+        # Resolve the profile once; signaling handlers only compare against it
+        self.user_profile, chat_room = await self.load_room_access()
+        if not chat_room:
             await self.close()
             return
 
-        # Join call signaling group
+        peer = chat_room.get_other_participant(self.user_profile)
+        self.participant_group_name = call_group_name(self.room_name, self.user_profile.id)
+        self.peer_group_name = call_group_name(self.room_name, peer.id)
+
+        # Join this participant's signaling group
         await self.channel_layer.group_add(
-            self.call_group_name,
+            self.participant_group_name,
             self.channel_name
         )
 
@@ -186,122 +231,97 @@ class CallSignalingConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         """Leave call signaling group"""
+        if not hasattr(self, 'participant_group_name'):
+            return
+
         # Notify other user if in active call
-        await self.channel_layer.group_send(
-            self.call_group_name,
-            {
-                'type': 'user_disconnected',
-                'username': self.user.username,
-            }
-        )
+        await self.send_to_peer({
+            'type': 'user_disconnected',
+            'username': self.user.username,
+        })
         
         await self.channel_layer.group_discard(
-            self.call_group_name,
+            self.participant_group_name,
             self.channel_name
         )
 
+    async def send_to_peer(self, event):
+        """Route a signaling event to the other participant's connections only"""
+        await self.channel_layer.group_send(self.peer_group_name, event)
+
     async def receive(self, text_data):
         """Receive signaling messages from WebSocket"""
         try:
             data = json.loads(text_data)
             message_type = data.get('type')
-            
-            # Get user profile
-            user_profile = await self.get_user_profile()
-            if not user_profile:
-                await self.send(text_data=json.dumps({
-                    'type': 'error',
-                    'message': 'User profile not found'
-                }))
-                return
+            user_profile = self.user_profile
             
             # Handle different message types
             if message_type == 'call_offer':
                 # Initiating a call - send WebRTC offer
-                await self.channel_layer.group_send(
-                    self.call_group_name,
-                    {
-                        'type': 'call_offer',
-                        'offer': data.get('offer'),
-                        'call_type': data.get('call_type', 'video'),
-                        'caller_id': user_profile.id,
-                        'caller_name': user_profile.name,
-                        'username': self.user.username,
-                    }
-                )
+                await self.send_to_peer({
+                    'type': 'call_offer',
+                    'offer': data.get('offer'),
+                    'call_type': data.get('call_type', 'video'),
+                    'caller_id': user_profile.id,
+                    'caller_name': user_profile.name,
+                    'username': self.user.username,
+                })
             
             elif message_type == 'call_answer':
                 # Answering a call - send WebRTC answer
-                await self.channel_layer.group_send(
-                    self.call_group_name,
-                    {
-                        'type': 'call_answer',
-                        'answer': data.get('answer'),
-                        'answerer_id': user_profile.id,
-                        'answerer_name': user_profile.name,
-                        'username': self.user.username,
-                    }
-                )
+                await self.send_to_peer({
+                    'type': 'call_answer',
+                    'answer': data.get('answer'),
+                    'answerer_id': user_profile.id,
+                    'answerer_name': user_profile.name,
+                    'username': self.user.username,
+                })
             
             elif message_type == 'ice_candidate':
                 # Exchange ICE candidates for NAT traversal
-                await self.channel_layer.group_send(
-                    self.call_group_name,
-                    {
-                        'type': 'ice_candidate',
-                        'candidate': data.get('candidate'),
-                        'sender_id': user_profile.id,
-                        'username': self.user.username,
-                    }
-                )
+                await self.send_to_peer({
+                    'type': 'ice_candidate',
+                    'candidate': data.get('candidate'),
+                    'sender_id': user_profile.id,
+                    'username': self.user.username,
+                })
             
             elif message_type == 'call_reject':
                 # Rejecting a call
-                await self.channel_layer.group_send(
-                    self.call_group_name,
-                    {
-                        'type': 'call_rejected',
-                        'rejector_id': user_profile.id,
-                        'rejector_name': user_profile.name,
-                        'username': self.user.username,
-                    }
-                )
+                await self.send_to_peer({
+                    'type': 'call_rejected',
+                    'rejector_id': user_profile.id,
+                    'rejector_name': user_profile.name,
+                    'username': self.user.username,
+                })
             
             elif message_type == 'call_end':
                 # Ending a call
-                await self.channel_layer.group_send(
-                    self.call_group_name,
-                    {
-                        'type': 'call_ended',
-                        'ender_id': user_profile.id,
-                        'ender_name': user_profile.name,
-                        'username': self.user.username,
-                    }
-                )
+                await self.send_to_peer({
+                    'type': 'call_ended',
+                    'ender_id': user_profile.id,
+                    'ender_name': user_profile.name,
+                    'username': self.user.username,
+                })
             
             elif message_type == 'request_to_join':
                 # User wants to join an active call
-                await self.channel_layer.group_send(
-                    self.call_group_name,
-                    {
-                        'type': 'call_join_request',
-                        'joiner_id': user_profile.id,
-                        'joiner_name': user_profile.name,
-                        'username': self.user.username,
-                    }
-                )
+                await self.send_to_peer({
+                    'type': 'call_join_request',
+                    'joiner_id': user_profile.id,
+                    'joiner_name': user_profile.name,
+                    'username': self.user.username,
+                })
             
             elif message_type == 'call_cancel':
                 # Cancelling a call before it's answered
-                await self.channel_layer.group_send(
-                    self.call_group_name,
-                    {
-                        'type': 'call_cancelled',
-                        'canceller_id': user_profile.id,
-                        'canceller_name': user_profile.name,
-                        'username': self.user.username,
-                    }
-                )
+                await self.send_to_peer({
+                    'type': 'call_cancelled',
+                    'canceller_id': user_profile.id,
+                    'canceller_name': user_profile.name,
+                    'username': self.user.username,
+                })
                 
         except json.JSONDecodeError:
             await self.send(text_data=json.dumps({
@@ -314,99 +334,190 @@ class CallSignalingConsumer(AsyncWebsocketConsumer):
                 'message': str(e)
             }))
 
-    # Handler methods for group messages
+    # Handler methods for events sent by the other participant
     async def call_offer(self, event):
         """Forward call offer to other participant"""
-        # Don't send to self
-        user_profile = await self.get_user_profile()
-        if user_profile and user_profile.id != event.get('caller_id'):
-            await self.send(text_data=json.dumps({
-                'type': 'call_offer',
-                'offer': event.get('offer'),
-                'call_type': event.get('call_type'),
-                'caller_id': event.get('caller_id'),
-                'caller_name': event.get('caller_name'),
-            }))
+        await self.send(text_data=json.dumps({
+            'type': 'call_offer',
+            'offer': event.get('offer'),
+            'call_type': event.get('call_type'),
+            'caller_id': event.get('caller_id'),
+            'caller_name': event.get('caller_name'),
+        }))
 
     async def call_answer(self, event):
         """Forward call answer to caller"""
-        user_profile = await self.get_user_profile()
-        if user_profile and user_profile.id != event.get('answerer_id'):
-            await self.send(text_data=json.dumps({
-                'type': 'call_answer',
-                'answer': event.get('answer'),
-                'answerer_id': event.get('answerer_id'),
-                'answerer_name': event.get('answerer_name'),
-            }))
+        await self.send(text_data=json.dumps({
+            'type': 'call_answer',
+            'answer': event.get('answer'),
+            'answerer_id': event.get('answerer_id'),
+            'answerer_name': event.get('answerer_name'),
+        }))
 
     async def ice_candidate(self, event):
         """Forward ICE candidate to other participant"""
-        user_profile = await self.get_user_profile()
-        if user_profile and user_profile.id != event.get('sender_id'):
-            await self.send(text_data=json.dumps({
-                'type': 'ice_candidate',
-                'candidate': event.get('candidate'),
-            }))
+        await self.send(text_data=json.dumps({
+            'type': 'ice_candidate',
+            'candidate': event.get('candidate'),
+        }))
 
     async def call_rejected(self, event):
         """Forward call rejection to caller"""
-        user_profile = await self.get_user_profile()
-        if user_profile and user_profile.id != event.get('rejector_id'):
-            await self.send(text_data=json.dumps({
-                'type': 'call_rejected',
-                'rejector_name': event.get('rejector_name'),
-            }))
+        await self.send(text_data=json.dumps({
+            'type': 'call_rejected',
+            'rejector_name': event.get('rejector_name'),
+        }))
 
     async def call_ended(self, event):
         """Forward call end to other participant"""
-        user_profile = await self.get_user_profile()
-        if user_profile and user_profile.id != event.get('ender_id'):
-            await self.send(text_data=json.dumps({
-                'type': 'call_ended',
-                'ender_name': event.get('ender_name'),
-            }))
+        await self.send(text_data=json.dumps({
+            'type': 'call_ended',
+            'ender_name': event.get('ender_name'),
+        }))
 
     async def call_cancelled(self, event):
         """Forward call cancellation to receiver"""
+        await self.send(text_data=json.dumps({
+            'type': 'call_cancelled',
+            'canceller_name': event.get('canceller_name'),
+        }))
+
+    async def call_join_request(self, event):
+        """Forward join request to other participants"""
+        await self.send(text_data=json.dumps({
+            'type': 'call_join_request',
+            'joiner_id': event['joiner_id'],
+            'joiner_name': event['joiner_name'],
+        }))
+
+    async def user_disconnected(self, event):
+        """Notify when other user disconnects"""
+        await self.send(text_data=json.dumps({
+            'type': 'user_disconnected',
+            'message': 'Other user disconnected'
+        }))
+    
+    @database_pool_to_async
+    def load_room_access(self):
+        """Return (profile, room) if the user may join this room, else (None, None)"""
+        return load_room_access(self.user, self.room_name)
+
+
+class PresenceConsumer(AsyncWebsocketConsumer):
+    """
+    WebSocket consumer pushing live presence changes to the nearby dashboard.
+
+    The dashboard joins one group per class at the viewer's current location,
+    so it only receives arrivals, departures and privacy changes of classmates
+    it is allowed to see. A full snapshot is sent on connect and whenever the
+    viewer's own location or classes change. Addresses resolved in the
+    background for the viewer's GPS fixes are pushed here too.
+    """
+
+    async def connect(self):
+        """Accept connection and subscribe to the viewer's presence groups"""
+        self.user = self.scope['user']
+        self.presence_groups = set()
+
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
         user_profile = await self.get_user_profile()
-        if user_profile and user_profile.id != event.get('canceller_id'):
+        if not user_profile:
+            await self.close()
+            return
+        self.profile_id = user_profile.id
+        self.student_group_name = presence.student_group_name(self.profile_id)
+
+        await self.channel_layer.group_add(
+            self.student_group_name,
+            self.channel_name
+        )
+
+        await self.accept()
+        await self.send_snapshot()
+
+    async def disconnect(self, close_code):
+        """Leave all presence groups"""
+        groups = set(self.presence_groups)
+        if hasattr(self, 'student_group_name'):
+            groups.add(self.student_group_name)
+        for group in groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def send_snapshot(self):
+        """Resubscribe to the viewer's current groups and send the full state"""
+        snapshot = await self.get_snapshot()
+        location = snapshot['location']
+        groups = set()
+        if location:
+            groups = {presence.group_name(location['id'], cls['id']) for cls in snapshot['classes']}
+
+        for group in self.presence_groups - groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        for group in groups - self.presence_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.presence_groups = groups
+
+        await self.send(text_data=json.dumps({
+            'type': 'snapshot',
+            'location': location,
+            'classes': snapshot['classes'],
+        }))
+
+    # Handler methods for group messages
+    async def presence_arrived(self, event):
+        """A visible classmate arrived at the viewer's location"""
+        if event['student']['id'] != self.profile_id:
             await self.send(text_data=json.dumps({
-                'type': 'call_cancelled',
-                'canceller_name': event.get('canceller_name'),
+                'type': 'arrived',
+                'class_code': event['class_code'],
+                'student': event['student'],
             }))
 
-    async def call_join_request(self, event):
-        """Forward join request to other participants"""
-        # Don't send to the person who requested to join
-        if self.user.username != event['username']:
+    async def presence_left(self, event):
+        """A classmate left the viewer's location or the class"""
+        if event['student_id'] != self.profile_id:
             await self.send(text_data=json.dumps({
-                'type': 'call_join_request',
-                'joiner_id': event['joiner_id'],
-                'joiner_name': event['joiner_name'],
+                'type': 'left',
+                'class_code': event['class_code'],
+                'student_id': event['student_id'],
             }))
 
-    async def user_disconnected(self, event):
-        """Notify when other user disconnects"""
-        if event.get('username') != self.user.username:
+    async def presence_privacy_changed(self, event):
+        """A classmate hid their location"""
+        if event['student_id'] != self.profile_id:
             await self.send(text_data=json.dumps({
-                'type': 'user_disconnected',
-                'message': 'Other user disconnected'
+                'type': 'privacy_changed',
+                'class_code': event['class_code'],
+                'student_id': event['student_id'],
             }))
-    
-    @database_sync_to_async
-    def check_room_access(self):
-        """Check if user has access to this room"""
-        try:
-            user_profile = StudentProfile.objects.get(user=self.user)
-            chat_room = ChatRoom.objects.get(room_name=self.room_name, is_active=True)
-            return chat_room.has_participant(user_profile)
-        except (StudentProfile.DoesNotExist, ChatRoom.DoesNotExist):
-            return False
-    
-    @database_sync_to_async
+
+    async def presence_moved(self, event):
+        """The viewer's own location or classes changed"""
+        await self.send_snapshot()
+
+    async def presence_address(self, event):
+        """The address for the viewer's latest GPS fix was resolved"""
+        await self.send(text_data=json.dumps({
+            'type': 'address',
+            'address': event['address'],
+        }))
+
+    @database_pool_to_async
     def get_user_profile(self):
         """Get user's student profile"""
         try:
             return StudentProfile.objects.get(user=self.user)
         except StudentProfile.DoesNotExist:
             return None
+
+    @database_pool_to_async
+    def get_snapshot(self):
+        """Load the viewer's visible classmates from the presence counters"""
+        try:
+            user_profile = StudentProfile.objects.select_related('current_location').get(id=self.profile_id)
+        except StudentProfile.DoesNotExist:
+            return {'location': None, 'classes': []}
+        return presence.snapshot(user_profile)
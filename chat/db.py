@@ -0,0 +1,40 @@
+"""
+Bounded thread pool for database work done by WebSocket consumers.
+
+channels' database_sync_to_async runs every call on one thread-sensitive
+executor, so all consumer queries in a process queue up behind each other.
+Django 4.2's async ORM methods (aget, acreate, aupdate) delegate to that same
+executor and don't help. Consumers use database_pool_to_async instead, which
+runs calls on a pool of CHAT_DB_POOL_SIZE threads. Each thread holds its own
+database connection, so the pool size is also the number of connections a
+process opens.
+
+SQLite allows one writer at a time and fails concurrent writes with
+"database is locked", so without CHAT_DB_POOL_SIZE the pool has a single
+thread there. It still keeps consumer queries off the thread-sensitive
+executor.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+
+def pool_size():
+    """CHAT_DB_POOL_SIZE if set, else 1 on SQLite and 8 elsewhere"""
+    size = getattr(settings, 'CHAT_DB_POOL_SIZE', None)
+    if size:
+        return size
+    if settings.DATABASES['default']['ENGINE'].endswith('sqlite3'):
+        return 1
+    return 8
+
+
+executor = ThreadPoolExecutor(max_workers=pool_size(), thread_name_prefix='chat-db')
+
+
+def database_pool_to_async(func):
+    """
+    Like channels' database_sync_to_async, but run on the shared pool.
+    Stale connections are closed before and after each call.
+    """
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=executor)
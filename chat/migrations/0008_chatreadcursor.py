@@ -0,0 +1,56 @@
+# Generated by Django 4.2.7 on 2026-10-16 22:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_cursors_from_read_flags(apps, schema_editor):
+    """Start each participant's cursor just before their first unread message"""
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Message = apps.get_model('chat', 'Message')
+    ChatReadCursor = apps.get_model('chat', 'ChatReadCursor')
+    
+    cursors = []
+    for room in ChatRoom.objects.all():
+        for participant_id in (room.participant1_id, room.participant2_id):
+            messages = Message.objects.filter(room=room).order_by('-timestamp', '-id')
+            first_unread = (
+                messages.filter(is_read=False).exclude(sender_id=participant_id)
+                .order_by('timestamp', 'id').first()
+            )
+            if first_unread is not None:
+                messages = messages.filter(timestamp__lt=first_unread.timestamp)
+            last_read = messages.first()
+            cursors.append(ChatReadCursor(
+                room=room,
+                participant_id=participant_id,
+                last_read_message=last_read,
+                last_read_at=last_read.timestamp if last_read else None,
+            ))
+    ChatReadCursor.objects.bulk_create(cursors, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_studentprofile_location_updated_idx'),
+        ('chat', '0007_call_calendar_event_id_call_email_sent_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_at', models.DateTimeField(blank=True, help_text='Timestamp of the last read message', null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('last_read_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_read_cursors', to='accounts.studentprofile')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='chat.chatroom')),
+            ],
+            options={
+                'unique_together': {('room', 'participant')},
+            },
+        ),
+        migrations.RunPython(create_cursors_from_read_flags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-16 23:01
+
+from django.db import migrations
+import uuid
+
+
+def gen_uid(apps, schema_editor):
+    """Adding the column gave existing messages one shared uid; give each its own"""
+    Message = apps.get_model('chat', 'Message')
+    batch = []
+    for message in Message.objects.only('id').iterator(chunk_size=2000):
+        message.uid = uuid.uuid4()
+        batch.append(message)
+        if len(batch) >= 2000:
+            Message.objects.bulk_update(batch, ['uid'])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ['uid'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_uid'),
+    ]
+
+    operations = [
+        migrations.RunPython(gen_uid, migrations.RunPython.noop),
+    ]
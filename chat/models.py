@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 from accounts.models import StudentProfile
 import uuid
 
@@ -60,6 +61,30 @@ class ChatRequest(models.Model):
         """Check if request can be cancelled (must be pending)"""
         return self.status == 'pending'
 
+class ChatRoomQuerySet(models.QuerySet):
+    def annotate_inbox(self, user_profile):
+        """
+        Annotate each room with unread_count (messages from the other
+        participant after their read cursor) and last_message_id, in a single query.
+        """
+        last_message = Message.objects.filter(room=models.OuterRef('pk')).order_by('-timestamp', '-id')
+        read_through = ChatReadCursor.objects.filter(
+            room=models.OuterRef('pk'),
+            participant=user_profile,
+        ).values('last_read_at')[:1]
+        return self.annotate(
+            read_through=models.Subquery(read_through),
+        ).annotate(
+            unread_count=models.Count(
+                'messages',
+                filter=~models.Q(messages__sender=user_profile) & (
+                    models.Q(read_through__isnull=True)
+                    | models.Q(messages__timestamp__gt=models.F('read_through'))
+                ),
+            ),
+            last_message_id=models.Subquery(last_message.values('id')[:1]),
+        )
+
 class ChatRoom(models.Model):
     """Model for DM chat rooms between two students"""
     room_name = models.CharField(max_length=100, unique=True, db_index=True)
@@ -85,6 +110,8 @@ class ChatRoom(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
     
+    objects = ChatRoomQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-updated_at']
         unique_together = [['participant1', 'participant2']]
@@ -114,10 +141,38 @@ class ChatRoom(models.Model):
         return user_profile in [self.participant1, self.participant2]
     
     def get_unread_count(self, user_profile):
-        """Get unread message count for a user"""
-        return self.messages.filter(
-            is_read=False
-        ).exclude(sender=user_profile).count()
+        """Get unread message count for a user (messages after their read cursor)"""
+        unread = self.messages.exclude(sender=user_profile)
+        cursor = self.read_cursors.filter(participant=user_profile).first()
+        if cursor and cursor.last_read_at:
+            unread = unread.filter(timestamp__gt=cursor.last_read_at)
+        return unread.count()
+    
+    def mark_read(self, user_profile, through=None):
+        """
+        Move the user's read cursor to the latest message in the room and
+        flag the other participant's unread messages read.
+        Pass through, the timestamp of the newest message the user has seen,
+        when that message may still be waiting in the write-behind buffer.
+        """
+        ChatReadCursor.mark_room_read(self, user_profile, through=through)
+        self.messages.filter(is_read=False).exclude(sender=user_profile).mark_read()
+
+class MessageQuerySet(models.QuerySet):
+    def mark_read(self):
+        """Mark every unread message in the queryset read with a single UPDATE"""
+        return self.filter(is_read=False).update(is_read=True, read_at=timezone.now())
+    
+    def newest_first(self):
+        """Order newest first, with the id as a tie-breaker for keyset pagination"""
+        return self.order_by('-timestamp', '-id')
+    
+    def before(self, timestamp, message_id):
+        """Messages strictly older than (timestamp, message_id)"""
+        return self.filter(
+            models.Q(timestamp__lt=timestamp)
+            | models.Q(timestamp=timestamp, id__lt=message_id)
+        )
 
 class Message(models.Model):
     """Model for chat messages"""
@@ -131,11 +186,15 @@ class Message(models.Model):
         on_delete=models.CASCADE,
         related_name='sent_messages'
     )
+    # Assigned when the message is created, so it can be broadcast before it is saved
+    uid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
     content = models.TextField(max_length=2000)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
     is_read = models.BooleanField(default=False)
     read_at = models.DateTimeField(null=True, blank=True)
     
+    objects = MessageQuerySet.as_manager()
+    
     class Meta:
         ordering = ['timestamp']
         indexes = [
@@ -149,11 +208,77 @@ class Message(models.Model):
     def mark_as_read(self):
         """Mark message as read"""
         if not self.is_read:
-            from django.utils import timezone
             self.is_read = True
             self.read_at = timezone.now()
             self.save()
 
+class ChatReadCursor(models.Model):
+    """
+    How far a participant has read in a chat room.
+    Everything up to last_read_at counts as read, so marking a room read is
+    one UPDATE and unread counts are a range count over (room, timestamp).
+    """
+    room = models.ForeignKey(
+        ChatRoom,
+        on_delete=models.CASCADE,
+        related_name='read_cursors'
+    )
+    participant = models.ForeignKey(
+        StudentProfile,
+        on_delete=models.CASCADE,
+        related_name='chat_read_cursors'
+    )
+    last_read_message = models.ForeignKey(
+        Message,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    last_read_at = models.DateTimeField(null=True, blank=True, help_text="Timestamp of the last read message")
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = [['room', 'participant']]
+    
+    def __str__(self):
+        return f"{self.participant.name} read {self.room.room_name} up to {self.last_read_at}"
+    
+    @classmethod
+    def mark_room_read(cls, room, participant, through=None):
+        """
+        Point the participant's cursor at the latest message in the room.
+        A single UPDATE when the cursor already exists. If through is given,
+        last_read_at is moved at least that far, so messages that are not
+        written yet count as read once they are. The cursor only ever moves
+        forward.
+        """
+        latest = Message.objects.filter(room=room).order_by('-timestamp', '-id')
+        latest_at = models.Subquery(latest.values('timestamp')[:1])
+        behind = models.Q(last_read_at__isnull=True) | models.Q(last_read_at__lt=latest_at)
+        updated = cls.objects.filter(room=room, participant=participant).update(
+            last_read_message=models.Case(
+                models.When(behind, then=models.Subquery(latest.values('id')[:1])),
+                default=models.F('last_read_message'),
+            ),
+            last_read_at=models.Case(models.When(behind, then=latest_at), default=models.F('last_read_at')),
+            updated_at=timezone.now(),
+        )
+        if not updated:
+            last_message = latest.first()
+            cls.objects.get_or_create(
+                room=room,
+                participant=participant,
+                defaults={
+                    'last_read_message': last_message,
+                    'last_read_at': last_message.timestamp if last_message else None,
+                },
+            )
+        if through is not None:
+            cls.objects.filter(room=room, participant=participant).filter(
+                models.Q(last_read_at__isnull=True) | models.Q(last_read_at__lt=through)
+            ).update(last_read_at=through)
+
 class Call(models.Model):
     """Model for voice/video calls between students"""
     CALL_TYPE_CHOICES = [
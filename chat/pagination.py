@@ -0,0 +1,34 @@
+"""
+Opaque cursors for keyset pagination of chat history.
+
+A cursor encodes the (timestamp, id) of the oldest message on a page; the
+next page is everything strictly before it in (timestamp, id) order. That
+seeks straight into the (room, timestamp) index, so every page costs the same
+no matter how far back it is.
+"""
+import base64
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(message):
+    """Return an opaque cursor pointing just before a message"""
+    raw = f'{message.timestamp.isoformat()}|{message.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Return the (timestamp, id) encoded in a cursor.
+    Raises ValueError if the cursor is malformed.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        timestamp, message_id = raw.rsplit('|', 1)
+        parsed = parse_datetime(timestamp)
+        message_id = int(message_id)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    if parsed is None:
+        raise ValueError('Invalid cursor')
+    return parsed, message_id
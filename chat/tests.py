@@ -1,3 +1,485 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.db import DatabaseError, connection
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from accounts import presence
+from accounts.models import StudentProfile, Class, StudentClass
+from locations.models import Location
+from .buffer import message_buffer, write_messages
+from .consumers import ChatConsumer, PresenceConsumer, CallSignalingConsumer
+from .db import database_pool_to_async, pool_size
+from .models import ChatRoom, Message, ChatReadCursor
+from .pagination import encode_cursor, decode_cursor
 
-# Create your tests here.
+
+def make_profile(username, **fields):
+    """Create a student named after their username"""
+    user = User.objects.create_user(username=username, password='password')
+    return StudentProfile.objects.create(user=user, name=username, year='junior', **fields)
+
+
+def make_room(first, second):
+    """Open a chat room between two students"""
+    return ChatRoom.objects.create(
+        room_name=ChatRoom.generate_room_name(first.user_id, second.user_id),
+        participant1=first, participant2=second,
+    )
+
+
+def websocket_communicator(consumer, path, user, **url_kwargs):
+    """Communicator for a consumer, with the scope the router and auth middleware would build"""
+    scope = {'type': 'websocket', 'path': path, 'headers': [], 'subprotocols': [], 'user': user}
+    if url_kwargs:
+        scope['url_route'] = {'kwargs': url_kwargs}
+    return ApplicationCommunicator(consumer.as_asgi(), scope)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class PresenceConsumerTest(TransactionTestCase):
+    def setUp(self):
+        presence.clear()
+        self.library = Location.objects.create(name='Library Test')
+        self.gym = Location.objects.create(name='Gym Test')
+        self.cs = Class.objects.create(code='TEST2340', name='Objects and Design')
+        self.viewer = make_profile('viewer', current_location=self.library, location_updated_at=timezone.now())
+        self.other = make_profile('other', current_location=self.gym, location_updated_at=timezone.now())
+        for profile in (self.viewer, self.other):
+            StudentClass.objects.create(student=profile, course=self.cs)
+
+    def update_other(self, **fields):
+        for name, value in fields.items():
+            setattr(self.other, name, value)
+        self.other.save()
+
+    def test_pushes_snapshot_and_deltas(self):
+        async_to_sync(self.run_dashboard)()
+
+    async def receive_json(self, communicator):
+        message = await communicator.receive_output(timeout=5)
+        self.assertEqual(message['type'], 'websocket.send')
+        return json.loads(message['text'])
+
+    async def run_dashboard(self):
+        communicator = websocket_communicator(PresenceConsumer, '/ws/presence/', self.viewer.user)
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual((await communicator.receive_output(timeout=5))['type'], 'websocket.accept')
+
+        snapshot = await self.receive_json(communicator)
+        self.assertEqual(snapshot['type'], 'snapshot')
+        self.assertEqual(snapshot['location']['id'], self.library.id)
+        self.assertEqual(snapshot['classes'][0]['students'], [])
+
+        await database_sync_to_async(self.update_other)(current_location=self.library)
+        event = await self.receive_json(communicator)
+        self.assertEqual(event['type'], 'arrived')
+        self.assertEqual(event['class_code'], 'TEST2340')
+        self.assertEqual(event['student']['name'], 'other')
+
+        await database_sync_to_async(self.update_other)(location_privacy='hidden')
+        event = await self.receive_json(communicator)
+        self.assertEqual(event['type'], 'privacy_changed')
+        self.assertEqual(event['student_id'], self.other.id)
+
+        # The viewer moving to the gym triggers a fresh snapshot there
+        self.viewer.current_location = self.gym
+        await database_sync_to_async(self.viewer.save)()
+        snapshot = await self.receive_json(communicator)
+        self.assertEqual(snapshot['type'], 'snapshot')
+        self.assertEqual(snapshot['location']['id'], self.gym.id)
+
+        await database_sync_to_async(presence.publish_address)(self.viewer.id, 'Gym Test, Atlanta')
+        self.assertEqual(await self.receive_json(communicator), {'type': 'address', 'address': 'Gym Test, Atlanta'})
+
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(timeout=5)
+
+
+class ChatRoomListTest(TestCase):
+    def setUp(self):
+        self.profile = make_profile('viewer')
+        self.client.force_login(self.profile.user)
+
+    def add_room(self, username, unread):
+        other = make_profile(username)
+        room = make_room(self.profile, other)
+        Message.objects.create(room=room, sender=self.profile, content='hi')
+        for i in range(unread):
+            Message.objects.create(room=room, sender=other, content=f'reply {i}')
+        return room
+
+    def load_inbox(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('chat:room_list'))
+        return response, len(queries)
+
+    def test_constant_queries_with_unread_counts_and_last_message(self):
+        self.add_room('first', unread=2)
+        _, single_room_queries = self.load_inbox()
+
+        self.add_room('second', unread=0)
+        self.add_room('third', unread=3)
+        response, queries = self.load_inbox()
+        self.assertEqual(queries, single_room_queries)
+
+        rooms = {room.other_participant.name: room for room in response.context['chat_rooms']}
+        self.assertEqual(rooms['first'].unread_count, 2)
+        self.assertEqual(rooms['second'].unread_count, 0)
+        self.assertEqual(rooms['third'].unread_count, 3)
+        self.assertEqual(rooms['third'].last_message.content, 'reply 2')
+        self.assertEqual(rooms['second'].last_message.sender, self.profile)
+
+
+class ReadCursorTest(TestCase):
+    def setUp(self):
+        self.viewer = make_profile('viewer')
+        self.other = make_profile('other')
+        self.room = make_room(self.viewer, self.other)
+        for i in range(5):
+            Message.objects.create(room=self.room, sender=self.other, content=f'message {i}')
+        Message.objects.create(room=self.room, sender=self.viewer, content='mine')
+
+    def test_marking_read_uses_constant_updates(self):
+        self.assertEqual(self.room.get_unread_count(self.viewer), 5)
+        self.room.mark_read(self.viewer)
+        self.assertEqual(self.room.get_unread_count(self.viewer), 0)
+
+        Message.objects.create(room=self.room, sender=self.other, content='later')
+        self.assertEqual(self.room.get_unread_count(self.viewer), 1)
+        with self.assertNumQueries(2):
+            self.room.mark_read(self.viewer)
+        cursor = ChatReadCursor.objects.get(room=self.room, participant=self.viewer)
+        self.assertEqual(cursor.last_read_message.content, 'later')
+        self.assertFalse(self.room.messages.exclude(sender=self.viewer).filter(is_read=False).exists())
+        self.assertFalse(self.room.messages.filter(sender=self.viewer, is_read=True).exists())
+
+    def test_cursor_never_moves_backward(self):
+        # Read over the socket while the message is still in the write buffer
+        buffered = Message(room=self.room, sender=self.other, content='buffered')
+        ChatReadCursor.mark_room_read(self.room, self.viewer, through=buffered.timestamp)
+        ChatReadCursor.mark_room_read(self.room, self.viewer)
+        write_messages([buffered])
+        self.assertEqual(self.room.get_unread_count(self.viewer), 0)
+
+    def test_queryset_mark_read(self):
+        with self.assertNumQueries(1):
+            updated = Message.objects.filter(room=self.room).mark_read()
+        self.assertEqual(updated, 6)
+        self.assertFalse(Message.objects.filter(read_at__isnull=True).exists())
+        self.assertEqual(Message.objects.filter(room=self.room).mark_read(), 0)
+
+    def test_opening_room_clears_inbox_unread_count(self):
+        self.client.force_login(self.viewer.user)
+        self.client.get(reverse('chat:room_detail', args=[self.room.room_name]))
+
+        room = ChatRoom.objects.annotate_inbox(self.viewer).get(id=self.room.id)
+        self.assertEqual(room.unread_count, 0)
+        # The other participant hasn't read the viewer's message yet
+        room = ChatRoom.objects.annotate_inbox(self.other).get(id=self.room.id)
+        self.assertEqual(room.unread_count, 1)
+
+
+class MessageHistoryTest(TestCase):
+    def setUp(self):
+        self.viewer = make_profile('viewer')
+        self.other = make_profile('other')
+        self.room = make_room(self.viewer, self.other)
+        # Identical timestamps exercise the id tie-breaker
+        self.messages = [Message.objects.create(room=self.room, sender=self.other, content=f'm{i}') for i in range(120)]
+        Message.objects.filter(id__in=[m.id for m in self.messages[40:80]]).update(timestamp=self.messages[60].timestamp)
+        for message in self.messages:
+            message.refresh_from_db()
+        self.client.force_login(self.viewer.user)
+
+    def test_room_shows_newest_page(self):
+        response = self.client.get(reverse('chat:room_detail', args=[self.room.room_name]))
+        contents = [m.content for m in response.context['messages']]
+        self.assertEqual(contents[0], 'm70')
+        self.assertEqual(contents[-1], 'm119')
+        self.assertEqual(decode_cursor(response.context['history_cursor'])[1], self.messages[70].id)
+
+    def test_pages_backward_without_gaps(self):
+        url = reverse('chat:message_history', args=[self.room.room_name])
+        seen = []
+        params = {'limit': 30}
+        while True:
+            data = self.client.get(url, params).json()
+            seen = [m['content'] for m in data['messages']] + seen
+            if not data['has_more']:
+                break
+            params['before'] = data['next_cursor']
+        self.assertEqual(seen, [f'm{i}' for i in range(120)])
+
+    def test_invalid_cursor(self):
+        url = reverse('chat:message_history', args=[self.room.room_name])
+        self.assertEqual(self.client.get(url, {'before': 'not-a-cursor'}).status_code, 400)
+        self.assertEqual(decode_cursor(encode_cursor(self.messages[0]))[1], self.messages[0].id)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CHAT_LONG_POLL_TIMEOUT=1,
+)
+class LongPollTest(TransactionTestCase):
+    def setUp(self):
+        self.viewer = make_profile('viewer')
+        self.other = make_profile('other')
+        self.room = make_room(self.viewer, self.other)
+        self.async_client.force_login(self.viewer.user)
+        self.viewer_client = Client()
+        self.viewer_client.force_login(self.viewer.user)
+        self.other_client = Client()
+        self.other_client.force_login(self.other.user)
+        self.wait_url = reverse('chat:wait_messages', args=[self.room.room_name])
+
+    def send_reply(self, content):
+        return self.other_client.post(reverse('chat:send_message', args=[self.room.room_name]), {'message': content})
+
+    async def start_waiting(self):
+        """Start a long poll and return once it is subscribed to the room's group"""
+        waiter = asyncio.ensure_future(self.async_client.get(self.wait_url))
+        groups = get_channel_layer().groups
+        while not groups.get(f'chat_{self.room.room_name}'):
+            self.assertFalse(waiter.done())
+            await asyncio.sleep(0)
+        return waiter
+
+    async def test_wakes_up_when_message_is_sent(self):
+        waiter = await self.start_waiting()
+        await sync_to_async(self.send_reply)('hello')
+        response = await asyncio.wait_for(waiter, timeout=1)
+        data = response.json()
+        self.assertTrue(data['supported'])
+        self.assertEqual([m['content'] for m in data['messages']], ['hello'])
+
+    async def test_keeps_waiting_through_own_messages(self):
+        waiter = await self.start_waiting()
+        await sync_to_async(self.viewer_client.post)(
+            reverse('chat:send_message', args=[self.room.room_name]), {'message': 'mine'},
+        )
+        await sync_to_async(self.send_reply)('reply')
+        response = await asyncio.wait_for(waiter, timeout=1)
+        self.assertEqual([m['content'] for m in response.json()['messages']], ['reply'])
+
+    async def test_returns_missed_messages_immediately(self):
+        await sync_to_async(self.send_reply)('earlier')
+        response = await self.async_client.get(self.wait_url, {'since': '2000-01-01T00:00:00+00:00'})
+        self.assertEqual(response.json()['count'], 1)
+
+    async def test_times_out_empty(self):
+        response = await self.async_client.get(self.wait_url)
+        self.assertEqual(response.json()['messages'], [])
+
+    async def test_unsupported_without_channel_layer(self):
+        with self.settings(CHANNEL_LAYERS={}):
+            response = await self.async_client.get(self.wait_url)
+        self.assertFalse(response.json()['supported'])
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class CallSignalingConsumerTest(TransactionTestCase):
+    def setUp(self):
+        self.caller = make_profile('caller')
+        self.callee = make_profile('callee')
+        self.room = make_room(self.caller, self.callee)
+
+    async def connect(self, profile):
+        communicator = websocket_communicator(
+            CallSignalingConsumer, f'/ws/call/{self.room.room_name}/', profile.user, room_name=self.room.room_name,
+        )
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual((await communicator.receive_output(timeout=5))['type'], 'websocket.accept')
+        # connection_established greeting
+        await communicator.receive_output(timeout=5)
+        return communicator
+
+    def test_forwards_signals_without_profile_lookups(self):
+        async_to_sync(self.run_call)()
+
+    async def run_call(self):
+        caller = await self.connect(self.caller)
+        callee = await self.connect(self.callee)
+
+        lookup = AssertionError('profile looked up on the hot path')
+        with mock.patch.object(StudentProfile.objects, 'get', side_effect=lookup):
+            for i in range(3):
+                await caller.send_input({
+                    'type': 'websocket.receive',
+                    'text': json.dumps({'type': 'ice_candidate', 'candidate': f'candidate-{i}'}),
+                })
+                message = await callee.receive_output(timeout=5)
+                self.assertEqual(json.loads(message['text'])['candidate'], f'candidate-{i}')
+            # The sender doesn't get its own candidates back
+            self.assertTrue(await caller.receive_nothing())
+
+        for communicator in (caller, callee):
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(timeout=5)
+
+    def test_disconnect_notifies_only_the_peer(self):
+        async_to_sync(self.run_disconnect)()
+
+    async def run_disconnect(self):
+        caller = await self.connect(self.caller)
+        callee = await self.connect(self.callee)
+
+        await caller.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await caller.wait(timeout=5)
+
+        message = await callee.receive_output(timeout=5)
+        self.assertEqual(json.loads(message['text'])['type'], 'user_disconnected')
+
+        await callee.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await callee.wait(timeout=5)
+
+
+class DatabasePoolTest(TestCase):
+    def test_calls_run_concurrently_on_the_pool(self):
+        # Both calls must be inside the function at once to pass the barrier,
+        # which a single-threaded executor would never allow
+        barrier = threading.Barrier(2, timeout=5)
+
+        pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='chat-db')
+        self.addCleanup(pool.shutdown)
+        with mock.patch('chat.db.executor', pool):
+            @database_pool_to_async
+            def wait_for_other_call():
+                barrier.wait()
+                return threading.current_thread().name
+
+        async def run_both():
+            return await asyncio.gather(wait_for_other_call(), wait_for_other_call())
+
+        names = async_to_sync(run_both)()
+        self.assertEqual(len(set(names)), 2)
+        self.assertTrue(all(name.startswith('chat-db') for name in names))
+
+    def test_single_thread_on_sqlite(self):
+        with self.settings(CHAT_DB_POOL_SIZE=None):
+            self.assertEqual(pool_size(), 1)
+        with self.settings(CHAT_DB_POOL_SIZE=4):
+            self.assertEqual(pool_size(), 4)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CHAT_MESSAGE_DURABILITY='buffered',
+    CHAT_MESSAGE_FLUSH_INTERVAL=60,
+)
+class BufferedMessageTest(TransactionTestCase):
+    def setUp(self):
+        self.sender = make_profile('sender')
+        self.recipient = make_profile('recipient')
+        self.room = make_room(self.sender, self.recipient)
+
+    def tearDown(self):
+        message_buffer.flush()
+
+    async def connect(self, profile):
+        communicator = websocket_communicator(
+            ChatConsumer, f'/ws/chat/{self.room.room_name}/', profile.user, room_name=self.room.room_name,
+        )
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual((await communicator.receive_output(timeout=5))['type'], 'websocket.accept')
+        return communicator
+
+    def test_broadcasts_before_writing(self):
+        room_updated_at = self.room.updated_at
+        data = async_to_sync(self.run_chat)()
+
+        # Broadcast with its uid while the write is still pending
+        self.assertEqual(data['message'], 'hello')
+        self.assertIsNone(data['message_id'])
+        self.assertFalse(Message.objects.exists())
+        self.assertEqual(message_buffer.pending_count(), 1)
+
+        self.assertEqual(message_buffer.flush(), 1)
+        message = Message.objects.get()
+        self.assertEqual(str(message.uid), data['message_uid'])
+        self.assertEqual(message.timestamp.isoformat(), data['timestamp'])
+        self.room.refresh_from_db()
+        self.assertGreater(self.room.updated_at, room_updated_at)
+        # The recipient saw it before it was written, and it still counts as read
+        self.assertEqual(self.room.get_unread_count(self.recipient), 0)
+
+    async def run_chat(self):
+        sender = await self.connect(self.sender)
+        recipient = await self.connect(self.recipient)
+
+        await sender.send_input({'type': 'websocket.receive', 'text': json.dumps({'message': 'hello'})})
+        data = json.loads((await recipient.receive_output(timeout=5))['text'])
+
+        # Disconnecting waits for the recipient's read cursor update to finish
+        for communicator in (sender, recipient):
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(timeout=5)
+        return data
+
+    @override_settings(CHAT_READ_DEBOUNCE_SECONDS=60)
+    def test_burst_moves_read_cursor_once(self):
+        with mock.patch.object(ChatConsumer, 'mark_room_read') as mark_room_read:
+            seen = async_to_sync(self.run_burst)()
+
+        moves = [call.kwargs['through'] for call in mark_room_read.call_args_list if call.kwargs.get('through')]
+        self.assertEqual([through.isoformat() for through in moves], [seen[-1]])
+
+    async def run_burst(self):
+        sender = await self.connect(self.sender)
+        recipient = await self.connect(self.recipient)
+
+        seen = []
+        for i in range(3):
+            await sender.send_input({'type': 'websocket.receive', 'text': json.dumps({'message': f'm{i}'})})
+            seen.append(json.loads((await recipient.receive_output(timeout=5))['text'])['timestamp'])
+
+        # The pending read is flushed when the recipient leaves
+        for communicator in (sender, recipient):
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(timeout=5)
+        return seen
+
+    def test_flush_writes_batch_and_bumps_rooms_once(self):
+        for i in range(3):
+            message_buffer.add(Message(room=self.room, sender=self.sender, content=f'message {i}'))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(message_buffer.flush(), 3)
+        statements = [query['sql'].split()[0] for query in queries.captured_queries]
+        self.assertEqual(statements.count('INSERT'), 1)
+        self.assertEqual(statements.count('UPDATE'), 1)
+        self.assertEqual(
+            list(self.room.messages.values_list('content', flat=True)),
+            ['message 0', 'message 1', 'message 2'],
+        )
+
+    @override_settings(CHAT_MESSAGE_FLUSH_RETRIES=2)
+    def test_failed_writes_are_retried_then_dropped(self):
+        failing = mock.patch('chat.buffer.write_messages', side_effect=DatabaseError('locked'))
+        message_buffer.add(Message(room=self.room, sender=self.sender, content='retried'))
+        with failing, self.assertLogs('chat.buffer', 'ERROR'):
+            self.assertEqual(message_buffer.flush(), 0)
+        self.assertEqual(message_buffer.pending_count(), 1)
+        self.assertEqual(message_buffer.flush(), 1)
+        self.assertTrue(self.room.messages.filter(content='retried').exists())
+
+        message_buffer.add(Message(room=self.room, sender=self.sender, content='dropped'))
+        with failing, self.assertLogs('chat.buffer', 'ERROR'):
+            message_buffer.flush()
+            message_buffer.flush()
+        self.assertEqual(message_buffer.pending_count(), 0)
+
+    @override_settings(CHAT_MESSAGE_DURABILITY='sync')
+    def test_sync_durability_writes_before_broadcast(self):
+        data = async_to_sync(self.run_chat)()
+        self.assertEqual(message_buffer.pending_count(), 0)
+        self.assertEqual(Message.objects.get().id, data['message_id'])
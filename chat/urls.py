@@ -14,6 +14,8 @@ urlpatterns = [
     path('rooms/<str:room_name>/', views.chat_room_detail, name='room_detail'),
     path('rooms/<str:room_name>/send/', views.send_message, name='send_message'),
     path('rooms/<str:room_name>/messages/', views.get_new_messages, name='get_messages'),
+    path('rooms/<str:room_name>/history/', views.message_history, name='message_history'),
+    path('rooms/<str:room_name>/wait/', views.wait_for_messages, name='wait_messages'),
     # Call-related URLs
     path('calls/initiate/<str:room_name>/', views.initiate_call, name='initiate_call'),
     path('calls/<int:call_id>/accept/', views.accept_call, name='accept_call'),
@@ -1,15 +1,25 @@
+import asyncio
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.http import JsonResponse
 from django.db.models import Q, Max
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from accounts.models import StudentProfile
 from .models import ChatRequest, ChatRoom, Message, Call
 from .forms import ChatRequestForm
+from .pagination import encode_cursor, decode_cursor
 from .google_meet import create_google_meet_event, delete_google_meet_event
 from .email_utils import send_call_notification_email
 
+# Messages per page of chat history
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 100
+
 @login_required
 def send_chat_request(request, recipient_id):
     """Send a chat request to another student"""
@@ -212,19 +222,22 @@ def chat_room_list(request):
         status='pending'
     ).select_related('sender').order_by('-created_at')
     
-    # Get all chat rooms where user is a participant
-    chat_rooms = ChatRoom.objects.filter(
+    # Get all chat rooms where user is a participant, with unread counts
+    # and the last message id annotated in the same query
+    chat_rooms = list(ChatRoom.objects.filter(
         Q(participant1=profile) | Q(participant2=profile),
         is_active=True
-    ).select_related('participant1', 'participant2').annotate(
+    ).select_related('participant1', 'participant2').annotate_inbox(profile).annotate(
         last_message_time=Max('messages__timestamp')
-    ).order_by('-updated_at')
+    ).order_by('-updated_at'))
     
-    # Add unread counts and last message for each room
+    # Fetch all last messages at once
+    last_messages = Message.objects.select_related('sender').in_bulk(
+        [room.last_message_id for room in chat_rooms if room.last_message_id]
+    )
     for room in chat_rooms:
         room.other_participant = room.get_other_participant(profile)
-        room.unread_count = room.get_unread_count(profile)
-        room.last_message = room.messages.order_by('-timestamp').first()
+        room.last_message = last_messages.get(room.last_message_id)
     
     return render(request, 'chat/room_list.html', {
         'chat_rooms': chat_rooms,
@@ -251,21 +264,23 @@ def chat_room_detail(request, room_name):
     # Get the other participant
     other_participant = chat_room.get_other_participant(profile)
     
-    # Get messages (last 50, can be paginated later)
-    messages_list = chat_room.messages.select_related('sender').order_by('timestamp')[:50]
-    
-    # Mark messages as read
-    unread_messages = chat_room.messages.filter(
-        is_read=False
-    ).exclude(sender=profile)
+    # Show the newest page of messages; older ones load through message_history
+    page = list(chat_room.messages.select_related('sender').newest_first()[:HISTORY_PAGE_SIZE + 1])
+    has_more = len(page) > HISTORY_PAGE_SIZE
+    messages_list = page[:HISTORY_PAGE_SIZE][::-1]
+    history_cursor = encode_cursor(messages_list[0]) if has_more else ''
+    # Polling picks up from the last rendered message, so nothing sent after render is missed
+    poll_since = messages_list[-1].timestamp if messages_list else timezone.now()
     
-    for msg in unread_messages:
-        msg.mark_as_read()
+    # Mark the room as read
+    chat_room.mark_read(profile)
     
     return render(request, 'chat/room_detail.html', {
         'chat_room': chat_room,
         'other_participant': other_participant,
         'messages': messages_list,
+        'history_cursor': history_cursor,
+        'poll_since': poll_since,
         'profile': profile
     })
 
@@ -299,8 +314,11 @@ def send_message(request, room_name):
             content=message_content
         )
         
-        # Update room's updated_at timestamp
-        chat_room.save()
+        # Update room's updated_at timestamp without rewriting the whole row
+        ChatRoom.objects.filter(pk=chat_room.pk).update(updated_at=timezone.now())
+        
+        # Push to WebSocket clients and long-polling waiters in the room
+        broadcast_message(chat_room, message, request.user, profile)
         
         return JsonResponse({
             'success': True,
@@ -343,10 +361,8 @@ def get_new_messages(request, room_name):
         # Get last 10 messages
         new_messages = chat_room.messages.exclude(sender=profile).select_related('sender').order_by('-timestamp')[:10]
     
-    # Mark as read
-    for msg in new_messages:
-        if not msg.is_read:
-            msg.mark_as_read()
+    # Mark the room as read
+    chat_room.mark_read(profile)
     
     messages_data = [{
         'id': msg.id,
@@ -361,6 +377,175 @@ def get_new_messages(request, room_name):
         'count': len(messages_data)
     })
 
+def broadcast_message(chat_room, message, user, sender_profile):
+    """Publish a saved message to the room's channel layer group"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    async_to_sync(channel_layer.group_send)(
+        f'chat_{chat_room.room_name}',
+        {
+            'type': 'chat_message',
+            'message': message.content,
+            'username': user.username,
+            'sender_name': sender_profile.name,
+            'sender_id': sender_profile.id,
+            'timestamp': message.timestamp.isoformat(),
+            'message_id': message.id,
+            'message_uid': str(message.uid),
+        }
+    )
+
+def _poll_context(user, room_name):
+    """Resolve the profile and room for a long-poll request, or an error response"""
+    try:
+        profile = user.student_profile
+    except StudentProfile.DoesNotExist:
+        return None, None, JsonResponse({'error': 'Profile not found.'}, status=400)
+    
+    chat_room = ChatRoom.objects.filter(room_name=room_name, is_active=True).first()
+    if chat_room is None:
+        return None, None, JsonResponse({'error': 'Chat room not found.'}, status=404)
+    if not chat_room.has_participant(profile):
+        return None, None, JsonResponse({'error': 'Access denied.'}, status=403)
+    return profile, chat_room, None
+
+def _event_message(event):
+    """Poll payload for a chat_message event whose message may not be written yet"""
+    return {
+        'id': event.get('message_id'),
+        'content': event['message'],
+        'sender_id': event['sender_id'],
+        'sender_name': event.get('sender_name', ''),
+        'timestamp': event['timestamp'],
+    }
+
+def _messages_since(chat_room, profile, since):
+    """Messages from the other participant newer than since, oldest first"""
+    new_messages = chat_room.messages.filter(
+        timestamp__gt=since
+    ).exclude(sender=profile).select_related('sender').order_by('timestamp', 'id')
+    return [{
+        'id': msg.id,
+        'content': msg.content,
+        'sender_id': msg.sender.id,
+        'sender_name': msg.sender.name,
+        'timestamp': msg.timestamp.isoformat(),
+    } for msg in new_messages]
+
+async def wait_for_messages(request, room_name):
+    """
+    Long-poll for new messages when the WebSocket is unavailable.
+    Holds the request until a message is published to the room's channel
+    layer group or CHAT_LONG_POLL_TIMEOUT seconds pass, so idle clients cost
+    one open connection instead of a request every few seconds. Answers
+    straight away with supported=False when there is no channel layer, and
+    the client falls back to interval polling of get_new_messages.
+    """
+    is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+    if not is_authenticated:
+        return JsonResponse({'error': 'Authentication required.'}, status=401)
+    
+    profile, chat_room, error = await sync_to_async(_poll_context)(request.user, room_name)
+    if error is not None:
+        return error
+    
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return JsonResponse({'messages': [], 'count': 0, 'supported': False})
+    
+    since = None
+    if request.GET.get('since'):
+        try:
+            since = parse_datetime(request.GET['since'])
+        except ValueError:
+            since = None
+    if since is None:
+        since = timezone.now()
+    
+    # Subscribe before checking the database so nothing slips in between
+    group_name = f'chat_{room_name}'
+    channel_name = await channel_layer.new_channel()
+    await channel_layer.group_add(group_name, channel_name)
+    try:
+        messages_data = await sync_to_async(_messages_since)(chat_room, profile, since)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + getattr(settings, 'CHAT_LONG_POLL_TIMEOUT', 25)
+        while not messages_data:
+            try:
+                event = await asyncio.wait_for(channel_layer.receive(channel_name), timeout=deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            # The viewer's own messages are already on their screen; keep waiting
+            if event.get('sender_id') == profile.id:
+                continue
+            messages_data = await sync_to_async(_messages_since)(chat_room, profile, since)
+            # Messages sent over the WebSocket can still be in the write-behind buffer
+            if not messages_data:
+                messages_data = [_event_message(event)]
+    finally:
+        await channel_layer.group_discard(group_name, channel_name)
+    
+    if messages_data:
+        through = parse_datetime(messages_data[-1]['timestamp'])
+        await sync_to_async(chat_room.mark_read)(profile, through=through)
+    
+    return JsonResponse({
+        'messages': messages_data,
+        'count': len(messages_data),
+        'supported': True,
+    })
+
+@login_required
+def message_history(request, room_name):
+    """
+    Page backward through a room's messages.
+    Pass the opaque `before` cursor from the previous page (or from the room
+    page) to get the next older page; messages come back oldest first.
+    """
+    try:
+        profile = request.user.student_profile
+    except StudentProfile.DoesNotExist:
+        return JsonResponse({'error': 'Profile not found.'}, status=400)
+    
+    chat_room = get_object_or_404(ChatRoom, room_name=room_name, is_active=True)
+    
+    # Verify user is a participant
+    if not chat_room.has_participant(profile):
+        return JsonResponse({'error': 'Access denied.'}, status=403)
+    
+    try:
+        limit = min(max(int(request.GET.get('limit', HISTORY_PAGE_SIZE)), 1), MAX_HISTORY_PAGE_SIZE)
+    except (TypeError, ValueError):
+        limit = HISTORY_PAGE_SIZE
+    
+    history = chat_room.messages.select_related('sender')
+    before = request.GET.get('before')
+    if before:
+        try:
+            history = history.before(*decode_cursor(before))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid cursor.'}, status=400)
+    
+    page = list(history.newest_first()[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit][::-1]
+    
+    messages_data = [{
+        'id': msg.id,
+        'content': msg.content,
+        'sender_id': msg.sender.id,
+        'sender_name': msg.sender.name,
+        'timestamp': msg.timestamp.isoformat(),
+    } for msg in page]
+    
+    return JsonResponse({
+        'messages': messages_data,
+        'count': len(messages_data),
+        'has_more': has_more,
+        'next_cursor': encode_cursor(page[0]) if has_more else None,
+    })
+
 # Call-related views
 
 @login_required
@@ -1,8 +1,14 @@
 from django.contrib import admin
-from .models import Location
+from .models import Location, GeocodeCacheEntry
 
 @admin.register(Location)
 class LocationAdmin(admin.ModelAdmin):
     list_display = ['name', 'building_name', 'is_active']
     list_filter = ['is_active']
     search_fields = ['name', 'building_name']
+
+@admin.register(GeocodeCacheEntry)
+class GeocodeCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ['key', 'hit_count', 'created_at', 'last_used_at']
+    search_fields = ['key']
+    readonly_fields = ['created_at', 'last_used_at', 'hit_count']
@@ -0,0 +1,77 @@
+"""
+Coalescing of GPS updates from browser geolocation watchers.
+
+Watchers can post a fix every few seconds. A fix is only written when the
+previous one is at least GPS_MIN_INTERVAL_SECONDS old and the student moved at
+least GPS_MIN_DISTANCE_METERS. Fixes dropped because the student barely moved
+still refresh location_updated_at once every GPS_HEARTBEAT_SECONDS, so their
+presence doesn't go stale while they sit in the same spot.
+"""
+import threading
+from django.conf import settings
+from . import geo
+
+APPLY = 'apply'
+HEARTBEAT = 'heartbeat'
+COALESCE = 'coalesce'
+
+_stats_lock = threading.Lock()
+_stats = {
+    'applied': 0,
+    'heartbeats': 0,
+    'coalesced': 0,
+}
+
+_STAT_FOR_DECISION = {
+    APPLY: 'applied',
+    HEARTBEAT: 'heartbeats',
+    COALESCE: 'coalesced',
+}
+
+
+def gps_update_stats():
+    """Return applied/heartbeat/coalesced counters for this process"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_gps_update_stats():
+    """Reset the counters returned by gps_update_stats()"""
+    with _stats_lock:
+        for counter in _stats:
+            _stats[counter] = 0
+
+
+def _settings():
+    return (
+        getattr(settings, 'GPS_MIN_DISTANCE_METERS', 25),
+        getattr(settings, 'GPS_MIN_INTERVAL_SECONDS', 30),
+        getattr(settings, 'GPS_HEARTBEAT_SECONDS', 300),
+    )
+
+
+def check_update(profile, latitude, longitude, now):
+    """
+    Decide what to do with a new fix for a profile and count the decision.
+    Returns APPLY (write the fix), HEARTBEAT (only refresh
+    location_updated_at) or COALESCE (write nothing).
+    """
+    min_distance, min_interval, heartbeat = _settings()
+
+    if not profile.has_gps_coordinates() or profile.location_updated_at is None:
+        decision = APPLY
+    else:
+        elapsed = (now - profile.location_updated_at).total_seconds()
+        moved = geo.haversine(profile.current_latitude, profile.current_longitude, latitude, longitude)
+        if elapsed < min_interval:
+            decision = COALESCE
+        elif moved >= min_distance:
+            decision = APPLY
+        elif elapsed >= heartbeat:
+            decision = HEARTBEAT
+        else:
+            decision = COALESCE
+
+    with _stats_lock:
+        _stats[_STAT_FOR_DECISION[decision]] += 1
+    return decision
@@ -0,0 +1,115 @@
+"""
+Geographic helpers shared by the locations and accounts apps.
+"""
+from math import radians, degrees, cos, sin, asin, sqrt, floor
+import numpy as np
+
+# Earth's radius in meters
+EARTH_RADIUS_METERS = 6371000
+
+# Meters spanned by one degree of latitude
+METERS_PER_DEGREE_LAT = 111320
+
+# Size of one grid cell in degrees (~1.1 km of latitude)
+GRID_CELL_DEGREES = 0.01
+
+
+def grid_cell(latitude, longitude):
+    """
+    Return the grid cell key ("row:col") containing the given point.
+    Returns an empty string if either coordinate is missing.
+    """
+    if latitude is None or longitude is None:
+        return ''
+    row = floor(latitude / GRID_CELL_DEGREES)
+    col = floor(longitude / GRID_CELL_DEGREES)
+    return f"{row}:{col}"
+
+
+def bounding_box(latitude, longitude, radius_meters):
+    """
+    Return (min_lat, max_lat, min_lon, max_lon) of a box that fully
+    contains the circle of radius_meters around the given point.
+    """
+    dlat = radius_meters / METERS_PER_DEGREE_LAT
+    # Longitude degrees shrink towards the poles; clamp to avoid dividing by zero
+    lat_cos = max(cos(radians(latitude)), 1e-6)
+    dlon = degrees(radius_meters / (EARTH_RADIUS_METERS * lat_cos))
+    return (
+        max(latitude - dlat, -90.0),
+        min(latitude + dlat, 90.0),
+        max(longitude - dlon, -180.0),
+        min(longitude + dlon, 180.0),
+    )
+
+
+def cells_within(latitude, longitude, radius_meters):
+    """
+    Return the list of grid cell keys that overlap the bounding box
+    of a radius_meters circle around the given point.
+    """
+    min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, radius_meters)
+    row_range = range(floor(min_lat / GRID_CELL_DEGREES), floor(max_lat / GRID_CELL_DEGREES) + 1)
+    col_range = range(floor(min_lon / GRID_CELL_DEGREES), floor(max_lon / GRID_CELL_DEGREES) + 1)
+    return [f"{row}:{col}" for row in row_range for col in col_range]
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Calculate distance in meters between two points using Haversine formula"""
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    
+    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(min(a, 1.0)))
+    
+    return EARTH_RADIUS_METERS * c
+
+
+def haversine_many(latitude, longitude, latitudes, longitudes):
+    """
+    Calculate distances in meters from one origin to many points in a single pass.
+    Returns a NumPy array.
+    """
+    lats = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lons = np.radians(np.asarray(longitudes, dtype=np.float64))
+    lat0 = radians(latitude)
+    lon0 = radians(longitude)
+    
+    a = np.sin((lats - lat0) / 2)**2 + cos(lat0) * np.cos(lats) * np.sin((lons - lon0) / 2)**2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def nearest(latitude, longitude, latitudes, longitudes, k=None, max_distance=None):
+    """
+    Rank points by distance from an origin.
+    Returns a list of (index, distance) tuples sorted by distance, limited to the
+    k closest points and/or points within max_distance meters when given.
+    """
+    count = len(latitudes)
+    if count == 0:
+        return []
+    distances = haversine_many(latitude, longitude, latitudes, longitudes)
+    
+    indices = np.arange(count)
+    if max_distance is not None:
+        indices = indices[distances <= max_distance]
+    if k is not None and k < len(indices):
+        # Partial selection of the k closest before sorting
+        indices = indices[np.argpartition(distances[indices], k)[:k]]
+    indices = indices[np.argsort(distances[indices], kind='stable')]
+    return [(int(i), float(distances[i])) for i in indices]
+
+
+def quantize(latitude, longitude, cell_meters):
+    """
+    Snap a point to a grid of roughly cell_meters x cell_meters cells.
+    Returns (key, center_latitude, center_longitude) for the containing cell.
+    """
+    lat_step = cell_meters / METERS_PER_DEGREE_LAT
+    row = floor(latitude / lat_step)
+    center_lat = (row + 0.5) * lat_step
+    # Use the row's center latitude so every point in a row shares the same column width
+    lon_step = cell_meters / (METERS_PER_DEGREE_LAT * max(cos(radians(center_lat)), 1e-6))
+    col = floor(longitude / lon_step)
+    center_lon = (col + 0.5) * lon_step
+    return f"{cell_meters}:{row}:{col}", center_lat, center_lon
@@ -0,0 +1,170 @@
+"""
+Reverse geocoder backends.
+
+The active backend is selected with the GEOCODER_BACKEND setting (a dotted
+path to a BaseGeocoder subclass):
+
+- locations.geocoders.NominatimGeocoder: OpenStreetMap Nominatim over HTTP
+- locations.geocoders.OfflineGeocoder: campus locations and the bundled
+  building dataset, resolved in-process with no network access
+"""
+import json
+import threading
+import urllib.request
+import urllib.parse
+from pathlib import Path
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+from . import geo
+
+ADDRESS_FIELDS = ['building', 'road', 'neighbourhood', 'city', 'state', 'postcode', 'country']
+
+DEFAULT_CAMPUS_DATASET = Path(__file__).resolve().parent / 'data' / 'campus_buildings.json'
+
+
+class BaseGeocoder:
+    """Interface for reverse geocoders"""
+    
+    # Remote backends are cached and resolved off the request path
+    is_remote = True
+    
+    def reverse(self, latitude, longitude):
+        """
+        Return address information for the coordinates, or None.
+        The dict has a display_name key plus the keys in ADDRESS_FIELDS.
+        """
+        raise NotImplementedError
+
+
+class NominatimGeocoder(BaseGeocoder):
+    """Reverse geocoder backed by the OpenStreetMap Nominatim API"""
+    
+    def __init__(self):
+        self.base_url = getattr(settings, 'NOMINATIM_URL', 'https://nominatim.openstreetmap.org/reverse')
+        self.timeout = getattr(settings, 'NOMINATIM_TIMEOUT', 10)
+    
+    def reverse(self, latitude, longitude):
+        try:
+            params = {
+                'format': 'json',
+                'lat': latitude,
+                'lon': longitude,
+                'zoom': 18,
+                'addressdetails': 1,
+            }
+            
+            url = f"{self.base_url}?{urllib.parse.urlencode(params)}"
+            
+            # Create request with User-Agent header (required by Nominatim)
+            req = urllib.request.Request(
+                url,
+                headers={'User-Agent': 'StudyIt/1.0 (Educational App)'}
+            )
+            
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                data = json.loads(response.read().decode())
+                
+                if 'error' in data:
+                    return None
+                
+                address = data.get('address', {})
+                
+                return {
+                    'display_name': data.get('display_name', ''),
+                    'building': address.get('building', address.get('amenity', '')),
+                    'road': address.get('road', ''),
+                    'neighbourhood': address.get('neighbourhood', address.get('suburb', '')),
+                    'city': address.get('city', address.get('town', address.get('village', ''))),
+                    'state': address.get('state', ''),
+                    'postcode': address.get('postcode', ''),
+                    'country': address.get('country', ''),
+                }
+        except Exception as e:
+            print(f"Geocoding error: {e}")
+            return None
+
+
+class OfflineGeocoder(BaseGeocoder):
+    """
+    Reverse geocoder that resolves coordinates against the active campus
+    Location rows and a bundled building dataset, without any network access.
+    Points farther than GEOCODER_OFFLINE_MAX_DISTANCE meters from every known
+    building resolve to None.
+    """
+    
+    is_remote = False
+    
+    def __init__(self):
+        self.max_distance = getattr(settings, 'GEOCODER_OFFLINE_MAX_DISTANCE', 150)
+        dataset_path = getattr(settings, 'GEOCODER_CAMPUS_DATASET', DEFAULT_CAMPUS_DATASET)
+        with open(dataset_path) as f:
+            dataset = json.load(f)
+        
+        self.defaults = {field: '' for field in ADDRESS_FIELDS}
+        self.defaults.update(dataset.get('defaults', {}))
+        self.buildings = dataset.get('buildings', [])
+        self.latitudes = np.asarray([building['latitude'] for building in self.buildings], dtype=np.float64)
+        self.longitudes = np.asarray([building['longitude'] for building in self.buildings], dtype=np.float64)
+    
+    def reverse(self, latitude, longitude):
+        from .registry import location_registry
+        
+        candidates = []
+        
+        nearest_building = geo.nearest(
+            latitude, longitude, self.latitudes, self.longitudes,
+            k=1, max_distance=self.max_distance,
+        )
+        if nearest_building:
+            index, distance = nearest_building[0]
+            candidates.append((distance, self._from_building(self.buildings[index])))
+        
+        nearest_location = location_registry.nearest(
+            latitude, longitude, k=1, max_distance=self.max_distance,
+        )
+        if nearest_location:
+            location, distance = nearest_location[0]
+            candidates.append((distance, self._from_location(location)))
+        
+        if not candidates:
+            return None
+        return min(candidates, key=lambda candidate: candidate[0])[1]
+    
+    def _build_address(self, **fields):
+        address = dict(self.defaults)
+        address.update({key: value for key, value in fields.items() if value})
+        parts = [address['building'], address['road'], address['neighbourhood'],
+                 address['city'], address['state'], address['postcode'], address['country']]
+        address['display_name'] = ', '.join(part for part in parts if part)
+        return address
+    
+    def _from_building(self, building):
+        return self._build_address(
+            building=building.get('building', ''),
+            road=building.get('road', ''),
+        )
+    
+    def _from_location(self, location):
+        address = self._build_address(building=location.building_name or location.name)
+        # Prefer an address recorded on the location itself
+        if location.address:
+            address['display_name'] = location.address
+        return address
+
+
+_geocoders = {}
+_geocoders_lock = threading.Lock()
+
+
+def get_geocoder():
+    """Return the configured geocoder backend instance"""
+    path = getattr(settings, 'GEOCODER_BACKEND', 'locations.geocoders.NominatimGeocoder')
+    geocoder = _geocoders.get(path)
+    if geocoder is None:
+        with _geocoders_lock:
+            geocoder = _geocoders.get(path)
+            if geocoder is None:
+                geocoder = import_string(path)()
+                _geocoders[path] = geocoder
+    return geocoder
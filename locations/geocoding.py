@@ -0,0 +1,147 @@
+"""
+Reverse geocoding with a persistent, quantized cache.
+
+Lookups go through the backend returned by geocoders.get_geocoder().
+Results from remote backends are cached: coordinates are snapped to cells of GEOCODE_CACHE_PRECISION_METERS so that
+students in the same building share one cached Nominatim lookup. Entries
+expire after GEOCODE_CACHE_TTL seconds and the least recently used ones are
+evicted once the table grows past GEOCODE_CACHE_MAX_ENTRIES.
+"""
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+from . import geo
+from .geocoders import get_geocoder
+from .models import GeocodeCacheEntry
+
+_stats_lock = threading.Lock()
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+}
+
+
+def _record(counter, amount=1):
+    with _stats_lock:
+        _stats[counter] += amount
+
+
+def geocode_cache_stats():
+    """Return hit/miss/eviction counters for this process"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_geocode_cache_stats():
+    """Reset the counters returned by geocode_cache_stats()"""
+    with _stats_lock:
+        for counter in _stats:
+            _stats[counter] = 0
+
+
+def _settings():
+    return (
+        getattr(settings, 'GEOCODE_CACHE_PRECISION_METERS', 20),
+        getattr(settings, 'GEOCODE_CACHE_TTL', 7 * 24 * 3600),
+        getattr(settings, 'GEOCODE_CACHE_MAX_ENTRIES', 10000),
+    )
+
+
+def get_cached_address(latitude, longitude, record_stats=True):
+    """
+    Return the cached address for the cell containing the coordinates,
+    or None if there is no fresh entry. Does not touch the network.
+    Pass record_stats=False when the lookup was already counted.
+    """
+    precision, ttl, _ = _settings()
+    key, _, _ = geo.quantize(latitude, longitude, precision)
+    now = timezone.now()
+    
+    entry = GeocodeCacheEntry.objects.filter(
+        key=key,
+        created_at__gte=now - timedelta(seconds=ttl),
+    ).first()
+    if entry is None:
+        if record_stats:
+            _record('misses')
+        return None
+    
+    GeocodeCacheEntry.objects.filter(pk=entry.pk).update(
+        hit_count=F('hit_count') + 1,
+        last_used_at=now,
+    )
+    if record_stats:
+        _record('hits')
+    return entry.data
+
+
+def store_address(latitude, longitude, address_info):
+    """Cache the address for the cell containing the coordinates"""
+    precision, _, max_entries = _settings()
+    key, center_lat, center_lon = geo.quantize(latitude, longitude, precision)
+    now = timezone.now()
+    
+    GeocodeCacheEntry.objects.update_or_create(
+        key=key,
+        defaults={
+            'latitude': center_lat,
+            'longitude': center_lon,
+            'data': address_info,
+            'hit_count': 0,
+            'created_at': now,
+            'last_used_at': now,
+        },
+    )
+    evict_entries(max_entries)
+
+
+def evict_entries(max_entries):
+    """Delete least recently used entries beyond max_entries"""
+    overflow = GeocodeCacheEntry.objects.count() - max_entries
+    if overflow <= 0:
+        return 0
+    
+    stale_ids = list(
+        GeocodeCacheEntry.objects.order_by('last_used_at').values_list('id', flat=True)[:overflow]
+    )
+    deleted, _ = GeocodeCacheEntry.objects.filter(id__in=stale_ids).delete()
+    _record('evictions', deleted)
+    return deleted
+
+
+def get_address_without_network(latitude, longitude):
+    """
+    Resolve coordinates without waiting on a remote geocoder: local backends
+    are queried directly, remote ones only through the cache.
+    Returns address information or None.
+    """
+    geocoder = get_geocoder()
+    if not geocoder.is_remote:
+        return geocoder.reverse(latitude, longitude)
+    return get_cached_address(latitude, longitude)
+
+
+def reverse_geocode(latitude, longitude, record_stats=True):
+    """
+    Reverse geocode coordinates, using the cache when possible.
+    Returns address information or None on failure. record_stats=False
+    re-checks the cache without counting a hit or miss, for lookups that
+    get_address_without_network already counted.
+    """
+    geocoder = get_geocoder()
+    if not geocoder.is_remote:
+        return geocoder.reverse(latitude, longitude)
+    
+    address_info = get_cached_address(latitude, longitude, record_stats=record_stats)
+    if address_info is not None:
+        return address_info
+    
+    address_info = geocoder.reverse(latitude, longitude)
+    # Only successful lookups are cached so transient failures get retried
+    if address_info is not None:
+        store_address(latitude, longitude, address_info)
+    return address_info
+
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-16 22:32
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('locations', '0003_location_address_location_latitude_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='Quantized coordinate cell', max_length=64, unique=True)),
+                ('latitude', models.FloatField(help_text='Latitude of the cell center')),
+                ('longitude', models.FloatField(help_text='Longitude of the cell center')),
+                ('data', models.JSONField(help_text='Address information returned by the geocoder')),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name_plural': 'Geocode cache entries',
+                'ordering': ['-last_used_at'],
+            },
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
-from math import radians, cos, sin, asin, sqrt
+from django.utils import timezone
+from . import geo
 
 class Location(models.Model):
     """Model for campus locations where students can study"""
@@ -31,19 +32,7 @@ class Location(models.Model):
         """
         if not self.has_coordinates():
             return None
-        
-        # Haversine formula
-        R = 6371000  # Earth's radius in meters
-        
-        lat1 = radians(self.latitude)
-        lat2 = radians(lat)
-        dlat = radians(lat - self.latitude)
-        dlon = radians(lon - self.longitude)
-        
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-        c = 2 * asin(sqrt(a))
-        
-        return R * c
+        return geo.haversine(self.latitude, self.longitude, lat, lon)
     
     def distance_to_location(self, other_location):
         """Calculate distance to another Location object"""
@@ -63,3 +52,21 @@ class Location(models.Model):
         else:
             km = meters / 1000
             return f"{km:.1f} km"
+
+
+class GeocodeCacheEntry(models.Model):
+    """Cached reverse geocoding result for a small grid cell"""
+    key = models.CharField(max_length=64, unique=True, help_text="Quantized coordinate cell")
+    latitude = models.FloatField(help_text="Latitude of the cell center")
+    longitude = models.FloatField(help_text="Longitude of the cell center")
+    data = models.JSONField(help_text="Address information returned by the geocoder")
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+    
+    class Meta:
+        ordering = ['-last_used_at']
+        verbose_name_plural = "Geocode cache entries"
+    
+    def __str__(self):
+        return f"{self.key} - {self.data.get('display_name', '')}"
@@ -0,0 +1,81 @@
+"""
+Process-level cache of active campus locations with nearest-neighbour lookups.
+
+The location table is small and rarely changes, so GPS updates and distance
+queries read from an in-memory snapshot instead of querying the database.
+The snapshot is invalidated by post_save/post_delete signals on Location
+(see signals.py) and also expires after LOCATION_REGISTRY_TTL seconds so
+other worker processes pick up changes made elsewhere.
+"""
+import threading
+import time
+import numpy as np
+from django.conf import settings
+from . import geo
+from .models import Location
+
+
+class _Snapshot:
+    """Immutable view of the active locations at a point in time"""
+
+    def __init__(self, locations):
+        self.locations = locations
+        self.by_id = {loc.id: loc for loc in locations}
+        self.located = [loc for loc in locations if loc.has_coordinates()]
+        self.unlocated = [loc for loc in locations if not loc.has_coordinates()]
+        self.latitudes = np.asarray([loc.latitude for loc in self.located], dtype=np.float64)
+        self.longitudes = np.asarray([loc.longitude for loc in self.located], dtype=np.float64)
+        self.built_at = time.monotonic()
+
+
+class LocationRegistry:
+    """In-memory registry of active locations"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def _ttl(self):
+        return getattr(settings, 'LOCATION_REGISTRY_TTL', 300)
+
+    def _get_snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None or time.monotonic() - snapshot.built_at > self._ttl():
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or time.monotonic() - snapshot.built_at > self._ttl():
+                    snapshot = _Snapshot(list(Location.objects.filter(is_active=True)))
+                    self._snapshot = snapshot
+        return snapshot
+
+    def invalidate(self):
+        """Drop the cached snapshot; the next lookup reloads from the database"""
+        self._snapshot = None
+
+    def get(self, location_id):
+        """Return the active location with the given ID, or None"""
+        return self._get_snapshot().by_id.get(location_id)
+
+    def nearest(self, latitude, longitude, k=1, max_distance=None):
+        """
+        Return up to k (location, distance) tuples closest to the given point,
+        optionally limited to locations within max_distance meters.
+        """
+        snapshot = self._get_snapshot()
+        ranked = geo.nearest(
+            latitude, longitude, snapshot.latitudes, snapshot.longitudes,
+            k=k, max_distance=max_distance,
+        )
+        return [(snapshot.located[index], distance) for index, distance in ranked]
+
+    def by_distance(self, latitude, longitude):
+        """
+        Return (location, distance) tuples for all active locations sorted by
+        distance. Locations without coordinates go last with a distance of None.
+        """
+        snapshot = self._get_snapshot()
+        ranked = self.nearest(latitude, longitude, k=None)
+        return ranked + [(loc, None) for loc in snapshot.unlocated]
+
+
+location_registry = LocationRegistry()
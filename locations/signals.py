@@ -0,0 +1,11 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Location
+from .registry import location_registry
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def invalidate_location_registry(sender, **kwargs):
+    """Reload the in-memory location registry whenever a location changes"""
+    location_registry.invalidate()
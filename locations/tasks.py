@@ -0,0 +1,78 @@
+"""
+Background workers for slow location work that should not block requests.
+
+Reverse geocoding runs on a small thread pool after the GPS update has been
+committed; the resolved address is written to StudentProfile.current_address
+and pushed to the student's open pages over the presence WebSocket.
+Set GEOCODE_ASYNC = False to resolve inline (useful for tests and scripts).
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from accounts import presence
+from .geocoding import reverse_geocode
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'GEOCODE_WORKER_THREADS', 2),
+                    thread_name_prefix='geocode',
+                )
+    return _executor
+
+
+def resolve_profile_address(profile_id, latitude, longitude):
+    """
+    Reverse geocode a GPS fix and store the address on the profile.
+    The write is skipped if the student has moved since the fix was queued.
+    """
+    from accounts.models import StudentProfile
+    
+    # The request already counted its cache miss; another worker may have
+    # filled the cell since, so check again without counting
+    address_info = reverse_geocode(latitude, longitude, record_stats=False)
+    if not address_info:
+        return None
+    
+    display_name = address_info.get('display_name', '')
+    updated = StudentProfile.objects.filter(
+        id=profile_id,
+        current_latitude=latitude,
+        current_longitude=longitude,
+    ).update(current_address=display_name)
+    if updated:
+        presence.publish_address(profile_id, display_name)
+    return address_info
+
+
+def _run_in_worker(profile_id, latitude, longitude):
+    close_old_connections()
+    try:
+        resolve_profile_address(profile_id, latitude, longitude)
+    except Exception:
+        logger.exception("Background geocoding failed for profile %s", profile_id)
+    finally:
+        # Worker threads are long-lived; don't leave their connection open
+        connection.close()
+
+
+def enqueue_address_lookup(profile_id, latitude, longitude):
+    """Schedule reverse geocoding for a profile once the current transaction commits"""
+    if not getattr(settings, 'GEOCODE_ASYNC', True):
+        transaction.on_commit(lambda: resolve_profile_address(profile_id, latitude, longitude))
+        return
+    
+    transaction.on_commit(
+        lambda: _get_executor().submit(_run_in_worker, profile_id, latitude, longitude)
+    )
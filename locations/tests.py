@@ -1,3 +1,298 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from unittest import mock
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from accounts import presence
+from accounts.models import StudentProfile
+from . import geo
+from .geocoding import reverse_geocode, store_address, geocode_cache_stats, reset_geocode_cache_stats
+from .models import Location, GeocodeCacheEntry
+from .registry import location_registry
+from .coalescing import gps_update_stats, reset_gps_update_stats
 
-# Create your tests here.
+
+class GpsStudentMixin:
+    """Logs in a student without a location, against a freshly loaded location registry"""
+
+    def setUp(self):
+        super().setUp()
+        location_registry.invalidate()
+        self.user = User.objects.create_user(username='gps', password='password')
+        self.profile = StudentProfile.objects.create(user=self.user, name="GPS Student", year="junior")
+        self.client.force_login(self.user)
+
+    def post_fix(self, latitude, longitude):
+        return self.client.post(
+            reverse('locations:update_gps'),
+            data=json.dumps({'latitude': latitude, 'longitude': longitude}),
+            content_type='application/json',
+        )
+
+
+class BatchDistanceTest(TestCase):
+    def setUp(self):
+        # Klaus, Clough Commons, Student Center, Tech Tower
+        self.lats = [33.7771, 33.7748, 33.7739, 33.7724]
+        self.lons = [-84.3963, -84.3964, -84.3988, -84.3947]
+
+    def test_haversine_many_matches_scalar(self):
+        distances = geo.haversine_many(33.7756, -84.3963, self.lats, self.lons)
+        for lat, lon, distance in zip(self.lats, self.lons, distances):
+            self.assertAlmostEqual(distance, geo.haversine(33.7756, -84.3963, lat, lon), places=3)
+
+    def test_nearest_sorts_and_limits(self):
+        ranked = geo.nearest(33.7770, -84.3963, self.lats, self.lons)
+        self.assertEqual([index for index, _ in ranked], [0, 1, 2, 3])
+
+        top = geo.nearest(33.7770, -84.3963, self.lats, self.lons, k=2)
+        self.assertEqual([index for index, _ in top], [0, 1])
+
+        within = geo.nearest(33.7770, -84.3963, self.lats, self.lons, max_distance=300)
+        self.assertEqual([index for index, _ in within], [0, 1])
+
+    def test_nearest_empty(self):
+        self.assertEqual(geo.nearest(33.7770, -84.3963, [], []), [])
+
+
+class LocationRegistryTest(TestCase):
+    def setUp(self):
+        location_registry.invalidate()
+        self.klaus = Location.objects.create(name='Klaus Test', latitude=33.7771, longitude=-84.3963)
+        self.clough = Location.objects.create(name='Clough Test', latitude=33.7748, longitude=-84.3964)
+        self.unknown = Location.objects.create(name='No Coordinates Test')
+
+    def test_nearest_uses_cached_snapshot(self):
+        location_registry.nearest(33.7770, -84.3963)
+        with self.assertNumQueries(0):
+            location, distance = location_registry.nearest(33.7770, -84.3963)[0]
+        self.assertEqual(location, self.klaus)
+        self.assertLess(distance, 50)
+
+    def test_by_distance_puts_unlocated_last(self):
+        ranked = location_registry.by_distance(33.7748, -84.3964)
+        names = [location.name for location, _ in ranked if location.name.endswith('Test')]
+        self.assertEqual(names, ['Clough Test', 'Klaus Test', 'No Coordinates Test'])
+        self.assertIsNone(ranked[-1][1])
+
+    def test_signals_invalidate_registry(self):
+        location_registry.nearest(33.7770, -84.3963)
+        self.klaus.is_active = False
+        self.klaus.save()
+        location, _ = location_registry.nearest(33.7770, -84.3963)[0]
+        self.assertEqual(location, self.clough)
+
+    def test_set_location_reads_registry(self):
+        user = User.objects.create_user(username='picker', password='password')
+        StudentProfile.objects.create(user=user, name='Picker', year='junior')
+        self.client.force_login(user)
+        url = reverse('locations:set_location')
+
+        response = self.client.post(url, json.dumps({'location_id': self.klaus.id}), content_type='application/json')
+        self.assertEqual(response.json()['location']['name'], 'Klaus Test')
+        self.assertEqual(StudentProfile.objects.get(user=user).current_location, self.klaus)
+
+        self.klaus.is_active = False
+        self.klaus.save()
+        response = self.client.post(url, json.dumps({'location_id': self.klaus.id}), content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+
+class GeocodeCacheTest(TestCase):
+    def setUp(self):
+        reset_geocode_cache_stats()
+        self.address = {'display_name': 'Klaus Advanced Computing Building'}
+
+    def test_nearby_points_share_cache_entry(self):
+        with mock.patch('locations.geocoders.NominatimGeocoder.reverse', return_value=self.address) as fetch:
+            self.assertEqual(reverse_geocode(33.77710, -84.39630), self.address)
+            # A few meters away falls in the same ~20 m cell
+            self.assertEqual(reverse_geocode(33.77712, -84.39631), self.address)
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(geocode_cache_stats()['hits'], 1)
+        self.assertEqual(geocode_cache_stats()['misses'], 1)
+
+    def test_failures_are_not_cached(self):
+        with mock.patch('locations.geocoders.NominatimGeocoder.reverse', return_value=None) as fetch:
+            reverse_geocode(33.7771, -84.3963)
+            reverse_geocode(33.7771, -84.3963)
+        self.assertEqual(fetch.call_count, 2)
+        self.assertFalse(GeocodeCacheEntry.objects.exists())
+
+    @override_settings(GEOCODE_CACHE_MAX_ENTRIES=2)
+    def test_least_recently_used_entries_are_evicted(self):
+        with mock.patch('locations.geocoders.NominatimGeocoder.reverse', return_value=self.address):
+            reverse_geocode(33.7771, -84.3963)
+            reverse_geocode(33.7748, -84.3964)
+            reverse_geocode(33.7771, -84.3963)  # refresh the first entry
+            reverse_geocode(33.7739, -84.3988)
+        self.assertEqual(GeocodeCacheEntry.objects.count(), 2)
+        self.assertEqual(geocode_cache_stats()['evictions'], 1)
+        key, _, _ = geo.quantize(33.7748, -84.3964, 20)
+        self.assertFalse(GeocodeCacheEntry.objects.filter(key=key).exists())
+
+
+@override_settings(GEOCODE_ASYNC=False)
+class GpsUpdateGeocodingTest(GpsStudentMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.address = {'display_name': 'Klaus Advanced Computing Building'}
+
+    def test_cache_miss_resolves_address_after_response(self):
+        reset_geocode_cache_stats()
+        with mock.patch('locations.geocoders.NominatimGeocoder.reverse', return_value=self.address) as fetch:
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                response = self.post_fix(33.7771, -84.3963)
+            self.assertTrue(response.json()['address_pending'])
+            self.assertEqual(fetch.call_count, 0)
+
+            channel_layer = mock.Mock(group_send=mock.AsyncMock())
+            with mock.patch('accounts.presence.get_channel_layer', return_value=channel_layer):
+                for callback in callbacks:
+                    callback()
+        self.assertEqual(geocode_cache_stats(), {'hits': 0, 'misses': 1, 'evictions': 0})
+        channel_layer.group_send.assert_called_once_with(
+            presence.student_group_name(self.profile.id),
+            {'type': 'presence.address', 'address': self.address['display_name']},
+        )
+
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.current_address, self.address['display_name'])
+        response = self.client.get(reverse('locations:current_address'))
+        self.assertTrue(response.json()['resolved'])
+
+    def test_cache_hit_returns_address_inline(self):
+        store_address(33.7771, -84.3963, self.address)
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            response = self.post_fix(33.7771, -84.3963)
+        self.assertEqual(response.json()['address'], self.address)
+        self.assertFalse(response.json()['address_pending'])
+        self.assertEqual(callbacks, [])
+
+
+@override_settings(
+    GEOCODER_BACKEND='locations.geocoders.OfflineGeocoder',
+    GPS_MIN_DISTANCE_METERS=25,
+    GPS_MIN_INTERVAL_SECONDS=30,
+    GPS_HEARTBEAT_SECONDS=300,
+)
+class GpsUpdateCoalescingTest(GpsStudentMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        reset_gps_update_stats()
+
+    def age_last_update(self, seconds):
+        StudentProfile.objects.filter(id=self.profile.id).update(
+            location_updated_at=timezone.now() - timedelta(seconds=seconds)
+        )
+
+    def test_rapid_and_small_updates_are_coalesced(self):
+        self.assertFalse(self.post_fix(33.7771, -84.3963).json()['coalesced'])
+
+        # Too soon, even though the student moved ~250 m
+        response = self.post_fix(33.7748, -84.3964)
+        self.assertTrue(response.json()['coalesced'])
+        self.assertEqual(response.json()['latitude'], 33.7771)
+
+        # Old enough but moved only ~10 m
+        self.age_last_update(60)
+        self.assertTrue(self.post_fix(33.7772, -84.3963).json()['coalesced'])
+
+        self.age_last_update(60)
+        self.assertFalse(self.post_fix(33.7748, -84.3964).json()['coalesced'])
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.current_latitude, 33.7748)
+
+        self.assertEqual(gps_update_stats(), {'applied': 2, 'heartbeats': 0, 'coalesced': 2})
+
+    def test_heartbeat_refreshes_timestamp_only(self):
+        self.post_fix(33.7771, -84.3963)
+        self.age_last_update(600)
+        updated_at = StudentProfile.objects.get(id=self.profile.id).updated_at
+
+        response = self.post_fix(33.7772, -84.3963)
+        self.assertTrue(response.json()['coalesced'])
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.current_latitude, 33.7771)
+        self.assertTrue(self.profile.has_fresh_presence())
+        self.assertEqual(self.profile.updated_at, updated_at)
+        self.assertEqual(gps_update_stats()['heartbeats'], 1)
+
+
+@override_settings(GEOCODER_BACKEND='locations.geocoders.OfflineGeocoder')
+class GpsBatchUpdateTest(GpsStudentMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.other_user = User.objects.create_user(username='other', password='password')
+        self.other = StudentProfile.objects.create(user=self.other_user, name="Other Student", year="junior")
+
+    def post_batch(self, fixes):
+        return self.client.post(
+            reverse('locations:update_gps_batch'),
+            data=json.dumps({'fixes': fixes}),
+            content_type='application/json',
+        )
+
+    def test_applies_newest_fix_per_student(self):
+        now = timezone.now()
+        response = self.post_batch([
+            {'latitude': 33.7748, 'longitude': -84.3964, 'timestamp': (now - timedelta(minutes=1)).isoformat()},
+            {'latitude': 33.7771, 'longitude': -84.3963, 'timestamp': int(now.timestamp() * 1000)},
+            {'latitude': 33.7739, 'longitude': -84.3988, 'timestamp': (now - timedelta(minutes=5)).isoformat()},
+            {'latitude': 'bad', 'longitude': -84.3963, 'timestamp': now.isoformat()},
+        ])
+        self.assertEqual(response.json()['applied'], 1)
+        self.assertEqual(response.json()['rejected'], 1)
+
+        self.profile.refresh_from_db()
+        self.assertEqual((self.profile.current_latitude, self.profile.current_longitude), (33.7771, -84.3963))
+        self.assertEqual(self.profile.location_cell, geo.grid_cell(33.7771, -84.3963))
+        self.assertIn('Klaus', self.profile.current_address)
+
+        # An older queued fix doesn't overwrite a newer location
+        response = self.post_batch([
+            {'latitude': 33.7748, 'longitude': -84.3964, 'timestamp': (now - timedelta(minutes=2)).isoformat()},
+        ])
+        self.assertEqual(response.json()['applied'], 0)
+
+    def test_fixes_only_update_the_sender(self):
+        self.user.is_staff = True
+        self.user.save()
+        now = timezone.now()
+        response = self.post_batch([
+            {'latitude': 33.7771, 'longitude': -84.3963, 'timestamp': now.isoformat(), 'user_id': self.other_user.id},
+            {'latitude': 33.7748, 'longitude': -84.3964, 'timestamp': now.isoformat(), 'user_id': True},
+        ])
+        self.assertEqual(response.json()['applied'], 1)
+        self.other.refresh_from_db()
+        self.assertIsNone(self.other.current_latitude)
+        self.profile.refresh_from_db()
+        self.assertIsNotNone(self.profile.current_latitude)
+
+
+@override_settings(GEOCODER_BACKEND='locations.geocoders.OfflineGeocoder')
+class OfflineGeocoderTest(TestCase):
+    def setUp(self):
+        location_registry.invalidate()
+
+    def test_resolves_campus_building_without_network(self):
+        with mock.patch('urllib.request.urlopen') as urlopen:
+            address = reverse_geocode(33.7771, -84.3963)
+        urlopen.assert_not_called()
+        self.assertEqual(address['building'], 'Klaus Advanced Computing Building')
+        self.assertIn('Atlanta', address['display_name'])
+        self.assertFalse(GeocodeCacheEntry.objects.exists())
+
+    def test_prefers_closer_seeded_location(self):
+        Location.objects.create(
+            name='Study Nook Test', building_name='Study Nook',
+            latitude=33.7800, longitude=-84.4100, address='1 Study Nook Way',
+        )
+        address = reverse_geocode(33.7801, -84.4100)
+        self.assertEqual(address['building'], 'Study Nook')
+        self.assertEqual(address['display_name'], '1 Study Nook Way')
+
+    def test_far_from_campus_returns_none(self):
+        self.assertIsNone(reverse_geocode(40.7128, -74.0060))
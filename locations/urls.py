@@ -6,6 +6,8 @@ app_name = 'locations'
 urlpatterns = [
     # GPS Location APIs
     path('api/update-gps/', views.update_gps_location, name='update_gps'),
+    path('api/update-gps/batch/', views.update_gps_location_batch, name='update_gps_batch'),
+    path('api/current-address/', views.current_address, name='current_address'),
     path('api/reverse-geocode/', views.reverse_geocode_view, name='reverse_geocode'),
     path('api/nearby-locations/', views.nearby_locations, name='nearby_locations'),
     path('api/nearby-classmates/', views.nearby_classmates_api, name='nearby_classmates_api'),
@@ -1,12 +1,22 @@
 import json
-import urllib.request
-import urllib.parse
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import transaction
 from django.shortcuts import render
 from django.http import JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_POST, require_GET
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.db.models import prefetch_related_objects
 from .models import Location
+from .registry import location_registry
+from .geocoding import reverse_geocode, get_address_without_network
+from .tasks import enqueue_address_lookup
+from .coalescing import check_update, APPLY, HEARTBEAT
+from . import geo
+from accounts import presence
 
 
 @login_required
@@ -40,10 +50,28 @@ def update_gps_location(request):
         except:
             return JsonResponse({'error': 'Student profile not found'}, status=400)
         
+        # Skip writes for fixes that come too soon or barely moved
+        now = timezone.now()
+        decision = check_update(profile, latitude, longitude, now)
+        if decision != APPLY:
+            if decision == HEARTBEAT:
+                profile.location_updated_at = now
+                profile.save(update_fields=['location_updated_at'])
+            return JsonResponse({
+                'success': True,
+                'message': 'Location unchanged',
+                'coalesced': True,
+                'latitude': profile.current_latitude,
+                'longitude': profile.current_longitude,
+                'address': {'display_name': profile.current_address} if profile.current_address else None,
+                'address_pending': not profile.current_address,
+                'location_updated_at': profile.location_updated_at.isoformat(),
+            })
+        
         # Update GPS coordinates
         profile.current_latitude = latitude
         profile.current_longitude = longitude
-        profile.location_updated_at = timezone.now()
+        profile.location_updated_at = now
         
         # Try to find nearest known location
         nearest_location = find_nearest_location(latitude, longitude)
@@ -51,17 +79,26 @@ def update_gps_location(request):
             # Only auto-select if within 500m
             profile.current_location = nearest_location['location']
         
-        profile.save()
+        # Use a local or cached address if we have one; otherwise resolve it in the background
+        address_info = get_address_without_network(latitude, longitude)
+        profile.current_address = address_info.get('display_name', '') if address_info else ''
+        
+        profile.save(update_fields=[
+            'current_latitude', 'current_longitude', 'location_updated_at',
+            'current_location', 'current_address',
+        ])
         
-        # Reverse geocode to get address (optional, may fail due to network)
-        address_info = reverse_geocode(latitude, longitude)
+        if address_info is None:
+            enqueue_address_lookup(profile.id, latitude, longitude)
         
         response_data = {
             'success': True,
             'message': 'Location updated successfully',
+            'coalesced': False,
             'latitude': latitude,
             'longitude': longitude,
             'address': address_info,
+            'address_pending': address_info is None,
             'location_updated_at': profile.location_updated_at.isoformat(),
         }
         
@@ -82,11 +119,161 @@ def update_gps_location(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+def _parse_fix(fix):
+    """
+    Validate one queued GPS fix.
+    Returns (latitude, longitude, timestamp) or None if the fix is invalid.
+    Timestamps may be ISO 8601 strings or epoch milliseconds (as reported by
+    the browser geolocation API); timestamps in the future are clamped to now.
+    """
+    if not isinstance(fix, dict):
+        return None
+    try:
+        latitude = float(fix['latitude'])
+        longitude = float(fix['longitude'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (-90 <= latitude <= 90) or not (-180 <= longitude <= 180):
+        return None
+    
+    raw_timestamp = fix.get('timestamp')
+    if isinstance(raw_timestamp, (int, float)) and not isinstance(raw_timestamp, bool):
+        try:
+            timestamp = datetime.fromtimestamp(raw_timestamp / 1000, tz=dt_timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            return None
+    elif isinstance(raw_timestamp, str):
+        try:
+            timestamp = parse_datetime(raw_timestamp)
+        except ValueError:
+            timestamp = None
+        if timestamp is None:
+            return None
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp, dt_timezone.utc)
+    else:
+        return None
+    
+    return latitude, longitude, min(timestamp, timezone.now())
+
+
+@login_required
+@require_POST
+def update_gps_location_batch(request):
+    """
+    Apply queued GPS fixes in one request.
+    Expects JSON body {"fixes": [{"latitude", "longitude", "timestamp"}, ...]}.
+    Only the newest fix is written, and only if it is newer than the stored
+    location.
+    """
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON data'}, status=400)
+    
+    fixes = data.get('fixes') if isinstance(data, dict) else None
+    if not isinstance(fixes, list):
+        return JsonResponse({'error': 'A list of fixes is required'}, status=400)
+    
+    max_fixes = getattr(settings, 'GPS_BATCH_MAX_FIXES', 1000)
+    if len(fixes) > max_fixes:
+        return JsonResponse({'error': f'At most {max_fixes} fixes per batch'}, status=400)
+    
+    # Keep the newest valid fix
+    newest = {}
+    rejected = 0
+    for fix in fixes:
+        parsed = _parse_fix(fix)
+        if parsed is None:
+            rejected += 1
+            continue
+        if request.user.id not in newest or parsed[2] > newest[request.user.id][2]:
+            newest[request.user.id] = parsed
+    
+    # Import here to avoid circular imports
+    from accounts.models import StudentProfile, StudentClass
+    
+    profiles = list(StudentProfile.objects.filter(user_id__in=newest.keys()))
+    updated = []
+    lookups = []
+    for profile in profiles:
+        latitude, longitude, timestamp = newest[profile.user_id]
+        # Skip fixes older than what we already have (e.g. a live update raced the queue)
+        if profile.location_updated_at and timestamp <= profile.location_updated_at:
+            continue
+        
+        profile.current_latitude = latitude
+        profile.current_longitude = longitude
+        profile.location_updated_at = timestamp
+        # bulk_update bypasses save(), so keep the grid cell index in sync here
+        profile.location_cell = geo.grid_cell(latitude, longitude)
+        
+        nearest_location = find_nearest_location(latitude, longitude)
+        if nearest_location and nearest_location.get('auto_select', False):
+            profile.current_location = nearest_location['location']
+        
+        address_info = get_address_without_network(latitude, longitude)
+        profile.current_address = address_info.get('display_name', '') if address_info else ''
+        if address_info is None:
+            lookups.append((profile.id, latitude, longitude))
+        updated.append(profile)
+    
+    # Every updated student's classes in one query, rather than one per student
+    class_ids_by_student = defaultdict(list)
+    class_codes = {}
+    enrollments = StudentClass.objects.filter(student__in=updated).values_list('student_id', 'course_id', 'course__code')
+    for student_id, class_id, code in enrollments:
+        class_ids_by_student[student_id].append(class_id)
+        class_codes[class_id] = code
+    
+    with transaction.atomic():
+        StudentProfile.objects.bulk_update(updated, [
+            'current_latitude', 'current_longitude', 'location_updated_at',
+            'location_cell', 'current_location', 'current_address',
+        ], batch_size=500)
+        # bulk_update skips signals, so sync presence counters and dashboards here
+        for profile in updated:
+            presence.update_student(profile, class_ids_by_student[profile.id], class_codes)
+        for profile_id, latitude, longitude in lookups:
+            enqueue_address_lookup(profile_id, latitude, longitude)
+    
+    return JsonResponse({
+        'success': True,
+        'received': len(fixes),
+        'rejected': rejected,
+        'students': len(newest),
+        'applied': len(updated),
+        'unknown_students': len(newest) - len(profiles),
+    })
+
+
+@login_required
+@require_GET
+def current_address(request):
+    """
+    Get the address resolved for the current user's latest GPS fix.
+    The presence WebSocket pushes it once resolved; clients check here when
+    they connect and fall back to polling when the socket is unavailable.
+    """
+    try:
+        profile = request.user.student_profile
+    except:
+        return JsonResponse({'error': 'Student profile not found'}, status=400)
+    
+    return JsonResponse({
+        'success': True,
+        'address': profile.current_address,
+        'resolved': bool(profile.current_address),
+        'latitude': profile.current_latitude,
+        'longitude': profile.current_longitude,
+    })
+
+
 @login_required
 @require_GET
 def reverse_geocode_view(request):
     """
-    Reverse geocode coordinates to get address using OpenStreetMap Nominatim.
+    Reverse geocode coordinates to get address using the configured geocoder.
     """
     latitude = request.GET.get('lat')
     longitude = request.GET.get('lon')
@@ -114,75 +301,16 @@ def reverse_geocode_view(request):
         })
 
 
-def reverse_geocode(latitude, longitude):
-    """
-    Use OpenStreetMap Nominatim API to reverse geocode coordinates.
-    Returns address information or None on failure.
-    """
-    try:
-        # Nominatim API endpoint
-        base_url = "https://nominatim.openstreetmap.org/reverse"
-        params = {
-            'format': 'json',
-            'lat': latitude,
-            'lon': longitude,
-            'zoom': 18,
-            'addressdetails': 1,
-        }
-        
-        url = f"{base_url}?{urllib.parse.urlencode(params)}"
-        
-        # Create request with User-Agent header (required by Nominatim)
-        req = urllib.request.Request(
-            url,
-            headers={'User-Agent': 'StudyIt/1.0 (Educational App)'}
-        )
-        
-        with urllib.request.urlopen(req, timeout=10) as response:
-            data = json.loads(response.read().decode())
-            
-            if 'error' in data:
-                return None
-            
-            address = data.get('address', {})
-            
-            return {
-                'display_name': data.get('display_name', ''),
-                'building': address.get('building', address.get('amenity', '')),
-                'road': address.get('road', ''),
-                'neighbourhood': address.get('neighbourhood', address.get('suburb', '')),
-                'city': address.get('city', address.get('town', address.get('village', ''))),
-                'state': address.get('state', ''),
-                'postcode': address.get('postcode', ''),
-                'country': address.get('country', ''),
-            }
-    except Exception as e:
-        print(f"Geocoding error: {e}")
-        return None
-
-
 def find_nearest_location(latitude, longitude, max_distance_meters=None):
     """
     Find the nearest known location.
     If max_distance_meters is provided, only return locations within that distance.
     Returns dict with location, distance, and whether it's within auto-select range.
     """
-    locations = Location.objects.filter(
-        is_active=True,
-        latitude__isnull=False,
-        longitude__isnull=False
-    )
+    ranked = location_registry.nearest(latitude, longitude)
     
-    nearest = None
-    min_distance = float('inf')
-    
-    for location in locations:
-        distance = location.distance_to(latitude, longitude)
-        if distance is not None and distance < min_distance:
-            min_distance = distance
-            nearest = location
-    
-    if nearest:
+    if ranked:
+        nearest, min_distance = ranked[0]
         # Auto-select threshold is 500m, but always return the nearest
         auto_select = min_distance <= 500 if max_distance_meters is None else min_distance <= max_distance_meters
         return {
@@ -227,11 +355,9 @@ def nearby_locations(request):
         except (TypeError, ValueError):
             return JsonResponse({'error': 'Invalid coordinate values'}, status=400)
     
-    # Get all active locations with coordinates
-    locations = Location.objects.filter(is_active=True)
-    
+    # Get all active locations sorted by distance (locations without coordinates go last)
     location_list = []
-    for loc in locations:
+    for loc, distance in location_registry.by_distance(latitude, longitude):
         loc_data = {
             'id': loc.id,
             'name': loc.name,
@@ -239,8 +365,7 @@ def nearby_locations(request):
             'has_coordinates': loc.has_coordinates(),
         }
         
-        if loc.has_coordinates():
-            distance = loc.distance_to(latitude, longitude)
+        if distance is not None:
             loc_data['distance_meters'] = distance
             loc_data['distance_formatted'] = Location.format_distance(distance)
             loc_data['latitude'] = loc.latitude
@@ -251,9 +376,6 @@ def nearby_locations(request):
         
         location_list.append(loc_data)
     
-    # Sort by distance (locations without coordinates go last)
-    location_list.sort(key=lambda x: x['distance_meters'] if x['distance_meters'] is not None else float('inf'))
-    
     return JsonResponse({
         'success': True,
         'user_coordinates': {
@@ -294,7 +416,8 @@ def nearby_classmates_api(request):
         })
     
     # Get user's classes
-    user_class_ids = set(profile.classes.values_list('id', flat=True))
+    prefetch_related_objects([profile], 'classes')
+    user_class_ids = {cls.id for cls in profile.classes.all()}
     
     if not user_class_ids:
         return JsonResponse({
@@ -306,22 +429,30 @@ def nearby_classmates_api(request):
     # Import here to avoid circular imports
     from accounts.models import StudentProfile
     
-    # Find classmates with GPS coordinates
+    # Find classmates with fresh GPS coordinates
     classmates = StudentProfile.objects.filter(
         is_active=True,
         classes__id__in=user_class_ids,
         current_latitude__isnull=False,
         current_longitude__isnull=False,
-    ).exclude(id=profile.id).select_related('user', 'current_location').prefetch_related('classes').distinct()
+    ).fresh_presence().visible_to(profile).exclude(id=profile.id).select_related('user', 'current_location').prefetch_related('classes').distinct()
+    
+    # Only classmates whose location the viewer can see
+    visible = list(classmates)
+    
+    # Rank by distance in one batch
+    ranked = geo.nearest(
+        user_lat, user_lon,
+        [classmate.current_latitude for classmate in visible],
+        [classmate.current_longitude for classmate in visible],
+    )
+    
+    shared_by_classmate = profile.get_shared_classes_bulk(visible)
     
     classmate_list = []
-    for classmate in classmates:
-        # Check if viewer can see this classmate's location
-        if not classmate.can_view_location(profile):
-            continue
-        
-        distance = classmate.distance_to(user_lat, user_lon)
-        shared_classes = profile.get_shared_classes(classmate)
+    for index, distance in ranked:
+        classmate = visible[index]
+        shared_classes = shared_by_classmate[classmate.id]
         
         classmate_list.append({
             'id': classmate.id,
@@ -336,9 +467,6 @@ def nearby_classmates_api(request):
             'longitude': classmate.current_longitude,
         })
     
-    # Sort by distance
-    classmate_list.sort(key=lambda x: x['distance_meters'] if x['distance_meters'] is not None else float('inf'))
-    
     return JsonResponse({
         'success': True,
         'user_coordinates': {
@@ -364,9 +492,12 @@ def set_location_from_selection(request):
         if not location_id:
             return JsonResponse({'error': 'Location ID is required'}, status=400)
         
+        # Active locations are already cached in the registry
         try:
-            location = Location.objects.get(id=location_id, is_active=True)
-        except Location.DoesNotExist:
+            location = location_registry.get(int(location_id))
+        except (TypeError, ValueError):
+            location = None
+        if location is None:
             return JsonResponse({'error': 'Location not found'}, status=404)
         
         try:
@@ -377,11 +508,12 @@ def set_location_from_selection(request):
         # Update location
         profile.current_location = location
         
+        profile.location_updated_at = timezone.now()
+        
         # If location has coordinates, update GPS coordinates too
         if location.has_coordinates():
             profile.current_latitude = location.latitude
             profile.current_longitude = location.longitude
-            profile.location_updated_at = timezone.now()
         
         profile.save()
         
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 from pathlib import Path
 import os
 from decouple import config
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -40,6 +41,7 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
     # Third-party apps
+    "channels",
     # "rest_framework",  # Temporarily commented out - install with: pip install djangorestframework==3.14.0
     # "corsheaders",  # Temporarily commented out - install with: pip install django-cors-headers==4.3.0
     # Local apps
@@ -79,6 +81,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "studyit_project.wsgi.application"
+ASGI_APPLICATION = "studyit_project.asgi.application"
 
 
 # Database
@@ -92,6 +95,80 @@ DATABASES = {
 }
 
 
+# Caches
+# Presence counters live in their own cache; set PRESENCE_REDIS_URL to share
+# them between worker processes
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "presence": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "presence",
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+}
+
+if os.environ.get('PRESENCE_REDIS_URL'):
+    CACHES["presence"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ['PRESENCE_REDIS_URL'],
+        "KEY_PREFIX": "studyit",
+    }
+
+# Seconds between full rebuilds of the presence counters
+PRESENCE_REBUILD_INTERVAL = int(os.environ.get('PRESENCE_REBUILD_INTERVAL', '300'))
+
+# Seconds after the last location update before a student's presence is stale.
+# Stale students are left out of nearby results and cleared by the
+# expire_stale_presence management command
+PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', '7200'))
+
+# Channel layers
+# Group messaging for chat, call signaling and presence. The in-memory layer
+# only reaches consumers in the same process; set CHANNEL_REDIS_URLS (comma
+# separated) to share it between ASGI workers. With several URLs, channels and
+# groups are sharded across the servers by hashing their names, so every
+# worker must list the same servers in the same order
+CHANNEL_REDIS_URLS = [
+    url.strip()
+    for url in os.environ.get('CHANNEL_REDIS_URLS', os.environ.get('REDIS_URL', '')).split(',')
+    if url.strip()
+]
+CHANNEL_LAYER_BACKEND = os.environ.get('CHANNEL_LAYER_BACKEND', 'redis' if CHANNEL_REDIS_URLS else 'memory')
+# Messages a single channel can queue before sends to it fail
+CHANNEL_LAYER_CAPACITY = int(os.environ.get('CHANNEL_LAYER_CAPACITY', '100'))
+# Seconds before a channel is dropped from its groups if it never left them
+CHANNEL_LAYER_GROUP_EXPIRY = int(os.environ.get('CHANNEL_LAYER_GROUP_EXPIRY', '86400'))
+
+if CHANNEL_LAYER_BACKEND == 'redis':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": CHANNEL_REDIS_URLS or ["redis://127.0.0.1:6379"],
+                "prefix": "studyit",
+                "capacity": CHANNEL_LAYER_CAPACITY,
+                "group_expiry": CHANNEL_LAYER_GROUP_EXPIRY,
+            },
+        },
+    }
+elif CHANNEL_LAYER_BACKEND == 'memory':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": {
+                "capacity": CHANNEL_LAYER_CAPACITY,
+                "group_expiry": CHANNEL_LAYER_GROUP_EXPIRY,
+            },
+        },
+    }
+else:
+    raise ImproperlyConfigured(
+        f"CHANNEL_LAYER_BACKEND must be 'memory' or 'redis', not {CHANNEL_LAYER_BACKEND!r}"
+    )
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -155,6 +232,56 @@ GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET')
 GOOGLE_REDIRECT_URI = os.environ.get('GOOGLE_REDIRECT_URI')
 
+# Study buddy recommendations
+# Seconds before a worker rebuilds its in-memory recommendation index
+RECOMMENDATION_INDEX_TTL = int(os.environ.get('RECOMMENDATION_INDEX_TTL', '600'))
+
+# Locations
+# Seconds before a worker reloads its in-memory location registry
+LOCATION_REGISTRY_TTL = int(os.environ.get('LOCATION_REGISTRY_TTL', '300'))
+
+# Reverse geocoding
+# Use "locations.geocoders.OfflineGeocoder" to resolve against campus buildings without network access
+GEOCODER_BACKEND = os.environ.get('GEOCODER_BACKEND', 'locations.geocoders.NominatimGeocoder')
+GEOCODER_OFFLINE_MAX_DISTANCE = int(os.environ.get('GEOCODER_OFFLINE_MAX_DISTANCE', '150'))
+GEOCODE_CACHE_PRECISION_METERS = int(os.environ.get('GEOCODE_CACHE_PRECISION_METERS', '20'))
+GEOCODE_CACHE_TTL = int(os.environ.get('GEOCODE_CACHE_TTL', str(7 * 24 * 3600)))
+GEOCODE_CACHE_MAX_ENTRIES = int(os.environ.get('GEOCODE_CACHE_MAX_ENTRIES', '10000'))
+# Resolve addresses for GPS updates on a background thread pool
+GEOCODE_ASYNC = os.environ.get('GEOCODE_ASYNC', 'True') == 'True'
+GEOCODE_WORKER_THREADS = int(os.environ.get('GEOCODE_WORKER_THREADS', '2'))
+
+# GPS updates closer together than GPS_MIN_INTERVAL_SECONDS, or that moved less
+# than GPS_MIN_DISTANCE_METERS, are not written. A student who stays put still
+# gets location_updated_at refreshed every GPS_HEARTBEAT_SECONDS
+GPS_MIN_DISTANCE_METERS = float(os.environ.get('GPS_MIN_DISTANCE_METERS', '25'))
+GPS_MIN_INTERVAL_SECONDS = int(os.environ.get('GPS_MIN_INTERVAL_SECONDS', '30'))
+GPS_HEARTBEAT_SECONDS = int(os.environ.get('GPS_HEARTBEAT_SECONDS', '300'))
+
+# Largest number of fixes accepted by the batch GPS endpoint
+GPS_BATCH_MAX_FIXES = int(os.environ.get('GPS_BATCH_MAX_FIXES', '1000'))
+
+# Seconds a chat long-poll request waits for a new message before returning empty
+CHAT_LONG_POLL_TIMEOUT = int(os.environ.get('CHAT_LONG_POLL_TIMEOUT', '25'))
+
+# Seconds a chat WebSocket waits before marking newly delivered messages read,
+# so a burst of messages moves the read cursor once
+CHAT_READ_DEBOUNCE_SECONDS = float(os.environ.get('CHAT_READ_DEBOUNCE_SECONDS', '2'))
+
+# Threads (and database connections) per process for WebSocket consumer queries.
+# Unset means 1 on SQLite, which takes one writer at a time, and 8 otherwise
+CHAT_DB_POOL_SIZE = int(os.environ.get('CHAT_DB_POOL_SIZE', '0')) or None
+
+# When chat messages sent over the WebSocket are written (see chat/buffer.py).
+# "buffered" broadcasts first and writes in batches every
+# CHAT_MESSAGE_FLUSH_INTERVAL seconds or CHAT_MESSAGE_FLUSH_SIZE messages, and
+# can lose the last batch if a worker crashes. "sync" writes before broadcasting
+CHAT_MESSAGE_DURABILITY = os.environ.get('CHAT_MESSAGE_DURABILITY', 'buffered')
+CHAT_MESSAGE_FLUSH_INTERVAL = float(os.environ.get('CHAT_MESSAGE_FLUSH_INTERVAL', '0.1'))
+CHAT_MESSAGE_FLUSH_SIZE = int(os.environ.get('CHAT_MESSAGE_FLUSH_SIZE', '100'))
+# Flushes a buffered message may fail before it is dropped
+CHAT_MESSAGE_FLUSH_RETRIES = int(os.environ.get('CHAT_MESSAGE_FLUSH_RETRIES', '3'))
+
 # CORS Settings (for development)
 CORS_ALLOW_ALL_ORIGINS = True  # Change in production
 